@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Optional
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is not admitted, instead of sending it to an overloaded Copilot LSP server.
+    """
+
+    def __init__(self, reason: str, message: str):
+        """
+        :param reason: "rate_limited", "queue_full" or "queue_timeout"
+        :param message: the description of the rejection
+        """
+        super().__init__(message)
+        self.reason = reason
+
+
+class TokenBucket(object):
+    """
+    A token bucket refilled with rate tokens per second, holding at most burst tokens. Not thread safe: the
+    AdmissionController calls it with its lock held.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"Invalid token bucket: rate {rate}, burst {burst}")
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def try_take(self, now: float) -> bool:
+        """
+        Take a token if there is one.
+        :param now: the current time.monotonic()
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def give_back(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class AdmissionController(object):
+    """
+    Thread safe admission control of the requests sent to a Copilot LSP server.
+
+    At most max_in_flight requests are admitted at a time. Further requests wait in a queue of at most max_queued
+    requests for up to queue_timeout seconds; a request arriving while the queue is full is rejected at once. Requests
+    can also be rate limited with token buckets, overall and per caller key. A rejected request raises
+    AdmissionRejected right away, so a burst degrades into quick rejections instead of requests timing out together.
+    """
+
+    def __init__(self, max_in_flight: int = 4,
+                 max_queued: int = 16,
+                 queue_timeout: Optional[float] = 1.0,
+                 rate: Optional[float] = None,
+                 burst: Optional[float] = None,
+                 key_rate: Optional[float] = None,
+                 key_burst: Optional[float] = None,
+                 max_keys: int = 10000):
+        """
+        :param max_in_flight: the maximum number of admitted requests in progress
+        :param max_queued: the maximum number of requests waiting for admission. 0 rejects every request arriving
+                           while max_in_flight requests are in progress.
+        :param queue_timeout: the number of seconds a request waits for admission, None to wait forever
+        :param rate: optional, the number of requests admitted per second overall
+        :param burst: the number of requests admitted at once above rate. Defaults to rate
+        :param key_rate: optional, the number of requests admitted per second for each caller key
+        :param key_burst: the number of requests admitted at once above key_rate for each caller key.
+                          Defaults to key_rate
+        :param max_keys: the maximum number of caller keys whose token bucket is kept. The least recently used ones
+                         are dropped.
+        """
+        if max_in_flight < 1:
+            raise ValueError(f"Invalid max_in_flight: {max_in_flight}")
+        if max_queued < 0:
+            raise ValueError(f"Invalid max_queued: {max_queued}")
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.key_rate = key_rate
+        self.key_burst = key_burst if key_burst is not None else key_rate
+        self.max_keys = max_keys
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._bucket = TokenBucket(rate, burst if burst is not None else rate) if rate is not None else None
+        self._key_buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    def _key_bucket(self, key: str) -> TokenBucket:
+        bucket = self._key_buckets.get(key)
+        if bucket is None:
+            bucket = self._key_buckets[key] = TokenBucket(self.key_rate, max(1, self.key_burst))
+            if len(self._key_buckets) > self.max_keys:
+                self._key_buckets.popitem(last=False)
+        else:
+            self._key_buckets.move_to_end(key)
+        return bucket
+
+    def _reject(self, reason: str, message: str):
+        self.rejected += 1
+        raise AdmissionRejected(reason, message)
+
+    def _take_tokens(self, key: Optional[str]) -> List[TokenBucket]:
+        """
+        Take a token from the rate limits of a request.
+        :return: the buckets the tokens were taken from, to give them back if the request is not admitted after all
+        """
+        now = time.monotonic()
+        key_bucket = self._key_bucket(key) if key is not None and self.key_rate is not None else None
+        if key_bucket is not None and not key_bucket.try_take(now):
+            self._reject("rate_limited", f"Rate limit exceeded for {key}")
+        if self._bucket is not None and not self._bucket.try_take(now):
+            if key_bucket is not None:
+                key_bucket.give_back()
+            self._reject("rate_limited", "Rate limit exceeded")
+        return [bucket for bucket in (key_bucket, self._bucket) if bucket is not None]
+
+    def acquire(self, key: str = None):
+        """
+        Wait for the admission of a request. Every admitted request must be released with release().
+        :param key: optional, the caller the request is rate limited for with key_rate
+        :raises: AdmissionRejected if the request is not admitted
+        """
+        with self._lock:
+            admitted = self.in_flight < self.max_in_flight and self.queued == 0
+            if not admitted and self.queued >= self.max_queued:
+                self._reject("queue_full", f"{self.in_flight} requests in progress and {self.queued} waiting")
+            buckets = self._take_tokens(key)
+            if admitted:
+                self.in_flight += 1
+                self.admitted += 1
+                return
+            self.queued += 1
+            try:
+                if not self._released.wait_for(lambda: self.in_flight < self.max_in_flight, self.queue_timeout):
+                    # a request that was never sent does not count against the rate limits
+                    for bucket in buckets:
+                        bucket.give_back()
+                    self._reject("queue_timeout", f"Not admitted within {self.queue_timeout} seconds")
+            finally:
+                self.queued -= 1
+            self.in_flight += 1
+            self.admitted += 1
+
+    def release(self):
+        """
+        Release an admitted request once it is finished.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            self._released.notify()
+
+    @contextmanager
+    def admit(self, key: str = None):
+        """
+        Admit a request for the duration of the with block. See acquire().
+        """
+        self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release()
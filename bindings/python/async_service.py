@@ -0,0 +1,214 @@
+import asyncio
+import collections
+import inspect
+import itertools
+import pathlib
+from typing import Callable, Union, Awaitable, AsyncIterator, List
+
+import pylspclient
+
+from model import CompletionRequestParams, CompletionResponse, SignInInitiative, PanelSolution
+from service import CopilotService
+from workspace import WorkspaceFolders
+
+
+class AsyncCopilotService(object):
+    """
+    asyncio Copilot service. It has the same API as CopilotService, but every request is a coroutine, so a single
+    event loop can wait for any number of completions without blocking a thread per request.
+
+    Use AsyncCopilotService.create() (or ``async with``) to get a started service.
+    """
+
+    _client_capabilities = CopilotService._client_capabilities
+
+    def __init__(self, root_path: str,
+                 copilot_agent_path: str = None,
+                 agent_command: List[str] = None,
+                 tracer: pylspclient.WireTracer = None):
+        """
+        Construct an asyncio Copilot service. The Copilot LSP server is not launched until start() is awaited.
+        :param root_path: the root directory that Copilot LSP server runs on. Usually this should be the root directory
+                          of the project for which Copilot suggests code completions.
+        :param copilot_agent_path: optional, the path to the Copilot LSP server (agent.js).
+                                   Defaults to the bundled Copilot LSP
+        :param agent_command: optional, the command line that launches the LSP server. See CopilotService.
+        :param tracer: optional, records the recent messages exchanged with the Copilot LSP server and its log
+                       messages. See CopilotService.
+        """
+        self.root_path = root_path
+        self.workspace = WorkspaceFolders(root_path)
+        self.copilot_agent_path = copilot_agent_path
+        self.agent_command = agent_command
+        self.tracer = tracer
+        self.p = None
+        self.lsp_endpoint = None
+        self.metrics = pylspclient.Metrics()
+        # the recent log messages of the Copilot LSP server
+        self.log_messages = collections.deque(maxlen=256)
+        self._panels = {}
+        self._panel_ids = itertools.count(1)
+
+    @classmethod
+    async def create(cls, root_path: str, copilot_agent_path: str = None,
+                     agent_command: List[str] = None,
+                     tracer: pylspclient.WireTracer = None) -> "AsyncCopilotService":
+        """
+        Construct and start an asyncio Copilot service.
+        See AsyncCopilotService.__init__ for the parameters.
+        """
+        service = cls(root_path, copilot_agent_path, agent_command, tracer)
+        await service.start()
+        return service
+
+    async def start(self):
+        """
+        Launch the Copilot LSP server and initialize it.
+        """
+        if self.agent_command is None:
+            await asyncio.get_running_loop().run_in_executor(None, CopilotService._check_dependency)
+            lsp_cmd = CopilotService._lsp_command(self.copilot_agent_path)
+        else:
+            lsp_cmd = self.agent_command
+        self.p = await asyncio.create_subprocess_exec(*lsp_cmd, stdin=asyncio.subprocess.PIPE,
+                                                      stdout=asyncio.subprocess.PIPE)
+        json_rpc_endpoint = pylspclient.AsyncJsonRpcEndpoint(self.p.stdout, self.p.stdin, self.metrics,
+                                                             self.tracer)
+        self.lsp_endpoint = pylspclient.AsyncLspEndpoint(json_rpc_endpoint,
+                                                         timeout=10,
+                                                         method_callback=self._callback,
+                                                         notify_callback=self._callback,
+                                                         metrics=self.metrics)
+        self.lsp_endpoint.start()
+        await self._initialize()
+
+    async def _initialize(self):
+        await self.lsp_endpoint.call_method("initialize", processId=self.p.pid, rootPath=self.root_path,
+                                            rootUri=pathlib.Path(self.root_path).as_uri(),
+                                            initializationOptions=None, capabilities=self._client_capabilities,
+                                            trace="off", workspaceFolders=self.workspace.to_list())
+        await self.lsp_endpoint.send_notification("initialized")
+
+    def _request_params(self, completion_request_params: CompletionRequestParams) -> dict:
+        return completion_request_params.to_dict(self.workspace.root_of(completion_request_params.doc_file)
+                                                 or self.root_path)
+
+    async def add_workspace_folder(self, path: str, name: str = None):
+        """
+        Add a workspace folder. See CopilotService.add_workspace_folder.
+        """
+        folder = self.workspace.add(path, name)
+        if folder is not None:
+            await self.lsp_endpoint.send_notification("workspace/didChangeWorkspaceFolders",
+                                                      event={"added": [folder], "removed": []})
+
+    async def remove_workspace_folder(self, path: str):
+        """
+        Remove a workspace folder. See CopilotService.remove_workspace_folder.
+        """
+        folder = self.workspace.remove(path)
+        if folder is not None:
+            await self.lsp_endpoint.send_notification("workspace/didChangeWorkspaceFolders",
+                                                      event={"added": [], "removed": [folder]})
+
+    async def shutdown(self):
+        """
+        Shutdown the Copilot service.
+        """
+        self.lsp_endpoint.stop()
+        await self.lsp_endpoint.call_method("shutdown")
+        self.p.terminate()
+        await self.p.wait()
+
+    async def __aenter__(self):
+        if self.p is None:
+            await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.shutdown()
+
+    async def get_completions(self, completion_request_params: CompletionRequestParams,
+                              timeout: float = None) -> CompletionResponse:
+        """
+        Get code completions. Cancelling the coroutine cancels the request on the Copilot LSP server.
+        :param completion_request_params: a CompletionRequestParams object that specifies the source code file
+                                          to suggest code completions for.
+        :param timeout: optional, the number of seconds to wait for the code completions. Defaults to the timeout of
+                        the service.
+        :return: CompletionResponse object, containing all the candidate code completions.
+        """
+        future = await self.lsp_endpoint.call_method_async("getCompletions",
+                                                           **self._request_params(completion_request_params))
+        if timeout is None:
+            return await self.lsp_endpoint.wait_for(future)
+        return await self.lsp_endpoint.wait_for(future, timeout)
+
+    async def get_panel_completions(self, completion_request_params: CompletionRequestParams,
+                                    timeout: float = None) -> AsyncIterator[PanelSolution]:
+        """
+        Get up to ten code completions, yielding each one as soon as the Copilot LSP server sends it.
+        See CopilotService.get_panel_completions.
+        """
+        timeout = timeout if timeout is not None else self.lsp_endpoint._timeout
+        panel_id = f"copilot:///{next(self._panel_ids)}"
+        solutions = asyncio.Queue()
+        self._panels[panel_id] = solutions
+        seen = set()
+        try:
+            await self.lsp_endpoint.wait_for(
+                await self.lsp_endpoint.call_method_async("getPanelCompletions", panelId=panel_id,
+                                                          **self._request_params(completion_request_params)),
+                timeout)
+            while True:
+                try:
+                    key, data = await asyncio.wait_for(solutions.get(), timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError()
+                if key == "PanelSolution":
+                    if data.get("solutionId") not in seen:
+                        seen.add(data.get("solutionId"))
+                        yield data
+                elif data.get("status") == "OK":
+                    return
+                else:
+                    raise Exception(f"Copilot panel completions failed: {data.get('message')}")
+        finally:
+            del self._panels[panel_id]
+
+    async def sign_in(self, callback: Callable[[SignInInitiative], Union[None, Awaitable[None]]]):
+        """
+        Sign in to Copilot.
+        :param callback: a function or coroutine function that takes a SignInInitiative object as input.
+                         See CopilotService.sign_in.
+        """
+        resp = await self.lsp_endpoint.call_method("signInInitiate", **dict())
+        result = callback(resp)
+        if inspect.isawaitable(result):
+            await result
+        return await self.lsp_endpoint.call_method("signInConfirm", **dict())
+
+    async def sign_out(self):
+        """
+        Sign out the current user of Copilot.
+        :return:
+        """
+        await self.lsp_endpoint.call_method("signOut", **dict())
+
+    async def signed_in(self) -> bool:
+        """
+        Check if a user is already signed in to Copilot.
+        :return:
+        """
+        resp = await self.lsp_endpoint.call_method("checkStatus", **{'options': {'localChecksOnly': True}})
+        return resp['status'] == 'OK' or resp['status'] == 'MaybeOK'
+
+    def _callback(self, key: str, data: dict):
+        if key == "PanelSolution" or key == "PanelSolutionsDone":
+            solutions = self._panels.get(data.get("panelId"))
+            if solutions is not None:
+                solutions.put_nowait((key, data))
+        elif key == "window/logMessage" or key == "LogMessage":
+            self.log_messages.append(data)
+            if self.tracer is not None:
+                self.tracer.log(key, data)
@@ -0,0 +1,108 @@
+import time
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+from typing import Callable, Iterable, Iterator, Tuple, Union, Optional, List
+
+from model import CompletionRequestParams, CompletionResponse, CompletionResponseCandidate
+
+
+def iter_completions(submit: Callable[[CompletionRequestParams], Future],
+                     params_iterable: Iterable[CompletionRequestParams],
+                     max_in_flight: int,
+                     timeout: Optional[float]
+                     ) -> Iterator[Tuple[CompletionRequestParams, Union[CompletionResponse, Exception]]]:
+    """
+    Request code completions for many params, keeping at most max_in_flight requests in progress, and yield the
+    results in the order they finish.
+    :param submit: sends a request and returns the Future of its response
+    :param params_iterable: the params to request code completions for. It is consumed lazily.
+    :param max_in_flight: the maximum number of requests in progress at a time
+    :param timeout: the number of seconds to wait for each request, None to wait forever
+    :return: an iterator of (params, response) tuples. The response is the exception raised by the request
+             if it failed, or a TimeoutError if it timed out.
+    """
+    if max_in_flight < 1:
+        raise ValueError(f"Invalid max_in_flight: {max_in_flight}")
+    params_iter = iter(params_iterable)
+    exhausted = False
+    in_flight = {}
+    try:
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                try:
+                    params = next(params_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                try:
+                    future = submit(params)
+                except Exception as e:
+                    yield params, e
+                    continue
+                deadline = time.monotonic() + timeout if timeout is not None else None
+                in_flight[future] = (params, deadline)
+            if not in_flight:
+                return
+
+            wait_timeout = None
+            if timeout is not None:
+                wait_timeout = max(0.0, min(deadline for _, deadline in in_flight.values()) - time.monotonic())
+            done, _ = wait(in_flight, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                params, _ = in_flight.pop(future)
+                if future.cancelled():
+                    yield params, TimeoutError()
+                elif future.exception() is not None:
+                    yield params, future.exception()
+                else:
+                    yield params, future.result()
+            if timeout is not None:
+                now = time.monotonic()
+                for future, (params, deadline) in list(in_flight.items()):
+                    if deadline <= now:
+                        del in_flight[future]
+                        future.cancel()
+                        yield params, TimeoutError()
+    finally:
+        # the caller stopped iterating, nobody is waiting for the remaining responses
+        for future in in_flight:
+            future.cancel()
+
+
+def _candidate_keys(candidate: CompletionResponseCandidate) -> Tuple[str, str]:
+    return candidate.get("uuid"), " ".join(candidate.get("text", "").split())
+
+
+def iter_merged_candidates(submits: List[Callable[[], Future]],
+                           concurrent: bool,
+                           timeout: Optional[float]) -> Iterator[CompletionResponseCandidate]:
+    """
+    Request code completions several ways and yield the candidates of all the responses as they arrive, skipping
+    candidates with the uuid or the text (ignoring whitespace differences) of a candidate yielded before.
+    :param submits: functions that send a request and return the Future of its CompletionResponse
+    :param concurrent: whether to send all the requests at once, or each one after the previous one finished
+    :param timeout: the number of seconds to wait for each request from when it is sent, None to wait forever. A
+                    request that times out is cancelled.
+    :return: an iterator of the unique candidates
+    :raises: the exception of the last request, or of sending it, if no request succeeded
+    """
+    # each request gets its own deadline from when it is sent, and the requests in progress are cancelled when the
+    # caller stops iterating
+    results = iter_completions(lambda submit: submit(), submits, len(submits) if concurrent else 1, timeout)
+    seen = set()
+    error = TimeoutError()
+    succeeded = False
+    try:
+        for _, response in results:
+            if isinstance(response, Exception):
+                error = response
+                continue
+            succeeded = True
+            for candidate in (response or {}).get("completions", []):
+                keys = _candidate_keys(candidate)
+                if seen.isdisjoint(keys):
+                    seen.update(keys)
+                    yield candidate
+    finally:
+        results.close()
+    if not succeeded:
+        raise error
@@ -0,0 +1,221 @@
+"""
+Benchmarks of the Copilot Python binding, run against the stand-in LSP server in stub_agent.py, so no Copilot
+account or network is needed.
+
+    python bench.py
+    python bench.py --requests 5000 --concurrency 1 8 64 --json results.json
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pylspclient  # noqa: E402
+from model import CompletionRequestParams  # noqa: E402
+from pool import CopilotServicePool  # noqa: E402
+from service import CopilotService  # noqa: E402
+
+STUB_AGENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_agent.py")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_FILE = os.path.join(ROOT, "virtual", "bench.py")
+
+
+def stub_command(*args) -> list:
+    return [sys.executable, STUB_AGENT] + [str(arg) for arg in args]
+
+
+def completion_params(source_size: int) -> CompletionRequestParams:
+    line = "value = compute(value)  # a line of source code\n"
+    source = line * max(1, source_size // len(line))
+    return CompletionRequestParams.from_source(source, SOURCE_FILE, "python",
+                                               {"line": source.count("\n"), "character": 0})
+
+
+def percentile(samples: list, fraction: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class _Sink(object):
+    """
+    A stdin that discards everything written to it.
+    """
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def flush(self):
+        pass
+
+
+def bench_framing(messages: int, payload_size: int) -> dict:
+    """
+    Encode and decode getCompletions responses with JsonRpcEndpoint, without any process in between.
+    """
+    text = "x" * payload_size
+    message = {"jsonrpc": "2.0", "id": 1, "result": {"completions": [{
+        "uuid": "00000000-0000-0000-0000-000000000000", "text": text, "displayText": text,
+        "position": {"line": 1, "character": 0},
+        "range": {"start": {"line": 1, "character": 0}, "end": {"line": 1, "character": 0}}}]}}
+
+    sink = _Sink()
+    endpoint = pylspclient.JsonRpcEndpoint(sink, None)
+    start = time.perf_counter()
+    for _ in range(messages):
+        endpoint.send_request(message)
+    encode_seconds = time.perf_counter() - start
+
+    data = pylspclient.json_rpc_endpoint.frame(message) * messages
+    endpoint = pylspclient.JsonRpcEndpoint(None, io.BufferedReader(io.BytesIO(data)))
+    start = time.perf_counter()
+    for _ in range(messages):
+        endpoint.recv_response()
+    decode_seconds = time.perf_counter() - start
+    return {
+        "payload_size": payload_size,
+        "encode_msgs_per_s": messages / encode_seconds,
+        "decode_msgs_per_s": messages / decode_seconds,
+        "decode_mb_per_s": len(data) / decode_seconds / 1e6,
+    }
+
+
+def bench_round_trip(service: CopilotService, requests: int, concurrency: int, source_size: int) -> dict:
+    """
+    Keep a window of getCompletions requests in flight on one LspEndpoint and measure their round-trip latency.
+    """
+    kwargs = completion_params(source_size).to_dict(ROOT)
+    latencies = []
+    window = threading.BoundedSemaphore(concurrency)
+    done = threading.Event()
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def finished(sent_at):
+        def callback(_):
+            latency = time.perf_counter() - sent_at
+            window.release()
+            with lock:
+                latencies.append(latency)
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    done.set()
+
+        return callback
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        window.acquire()
+        sent_at = time.perf_counter()
+        service.lsp_endpoint.call_method_async("getCompletions", **kwargs).add_done_callback(finished(sent_at))
+    done.wait()
+    seconds = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests_per_s": requests / seconds,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def bench_end_to_end(requests: int, latency: float, pool_size: int, source_size: int) -> dict:
+    """
+    Measure CopilotService.get_completions and CopilotServicePool.get_completions_batch against a stand-in server
+    that behaves like agent.js: it takes `latency` seconds per completion and handles one at a time.
+    """
+    params = completion_params(source_size)
+    command = stub_command("--latency", latency, "--supersede")
+    service = CopilotService(ROOT, agent_command=command)
+    try:
+        latencies = []
+        start = time.perf_counter()
+        for i in range(requests):
+            sent_at = time.perf_counter()
+            service.get_completions(params.with_position({"line": i, "character": 0}))
+            latencies.append(time.perf_counter() - sent_at)
+        serial_seconds = time.perf_counter() - start
+    finally:
+        service.shutdown()
+
+    pool = CopilotServicePool(ROOT, pool_size, agent_command=command)
+    try:
+        start = time.perf_counter()
+        all_params = (params.with_position({"line": i, "character": 0}) for i in range(requests))
+        for _, response in pool.get_completions_batch(all_params):
+            if isinstance(response, Exception):
+                raise response
+        pool_seconds = time.perf_counter() - start
+    finally:
+        pool.shutdown()
+    return {
+        "latency_ms": latency * 1000,
+        "serial_requests_per_s": requests / serial_seconds,
+        "serial_overhead_p50_ms": (statistics.median(latencies) - latency) * 1000,
+        "pool_size": pool_size,
+        "pool_requests_per_s": requests / pool_seconds,
+    }
+
+
+def print_table(title: str, rows: list):
+    print(title)
+    columns = list(rows[0])
+    cells = [[f"{row[column]:.2f}" if isinstance(row[column], float) else str(row[column]) for column in columns]
+             for row in rows]
+    widths = [max(len(column), *(len(line[i]) for line in cells)) for i, column in enumerate(columns)]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for line in cells:
+        print("  ".join(cell.rjust(width) for cell, width in zip(line, widths)))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per round-trip benchmark")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64],
+                        help="numbers of requests in flight for the round-trip benchmark")
+    parser.add_argument("--payload-sizes", type=int, nargs="+", default=[100, 10_000, 1_000_000],
+                        help="completion text sizes for the framing benchmark")
+    parser.add_argument("--source-size", type=int, default=20_000,
+                        help="the size of the source code sent with each request")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="seconds the stand-in server takes per completion in the end-to-end benchmark")
+    parser.add_argument("--end-to-end-requests", type=int, default=200,
+                        help="requests for the end-to-end benchmark")
+    parser.add_argument("--pool-size", type=int, default=os.cpu_count() or 1,
+                        help="Copilot services of the pool in the end-to-end benchmark")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {"framing": [], "round_trip": [], "end_to_end": []}
+    for payload_size in args.payload_sizes:
+        messages = max(10, min(20_000, 200_000_000 // (payload_size * 10)))
+        results["framing"].append(bench_framing(messages, payload_size))
+    print_table("JsonRpcEndpoint framing", results["framing"])
+
+    service = CopilotService(ROOT, agent_command=stub_command())
+    try:
+        for concurrency in args.concurrency:
+            results["round_trip"].append(bench_round_trip(service, args.requests, concurrency, args.source_size))
+    finally:
+        service.shutdown()
+    print_table("LspEndpoint round trip (getCompletions, no server latency)", results["round_trip"])
+
+    results["end_to_end"].append(bench_end_to_end(args.end_to_end_requests, args.latency, args.pool_size,
+                                                  args.source_size))
+    print_table("CopilotService end to end", results["end_to_end"])
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+A stand-in for the Copilot LSP server (agent.js), for benchmarking the Python binding without a signed-in Copilot.
+
+It speaks the same Content-Length framing on stdin/stdout and answers the methods used by the binding with
+synthetic code completions, after a configurable latency.
+
+    python stub_agent.py --latency 0.05 --completion-size 200
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import uuid
+
+
+class StubAgent(object):
+    def __init__(self, args):
+        self.args = args
+        self.stdin = sys.stdin.buffer
+        self.stdout = sys.stdout.buffer
+        self.write_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        # request id -> timer answering it
+        self.pending = {}
+        self.latest_completion = None
+        self.latest_panel = None
+        self.documents = {}
+        self.signed_in = True
+        self.completions = 0
+        self.hung = False
+        self.completion_text = ("x" * (args.completion_size - 1) + "\n") if args.completion_size > 0 else ""
+
+    def send(self, message):
+        message["jsonrpc"] = "2.0"
+        body = json.dumps(message).encode()
+        with self.write_lock:
+            self.stdout.write(b"Content-Length: %d\r\n\r\n" % len(body))
+            self.stdout.write(body)
+            self.stdout.flush()
+
+    def respond(self, rpc_id, result=None, error=None):
+        if error is not None:
+            self.send({"id": rpc_id, "error": error})
+        else:
+            self.send({"id": rpc_id, "result": result})
+
+    def notify(self, method, params):
+        self.send({"method": method, "params": params})
+
+    def latency(self):
+        return max(0.0, self.args.latency + random.uniform(-self.args.jitter, self.args.jitter))
+
+    def later(self, rpc_id, delay, answer):
+        """
+        Run answer after delay, unless the request is cancelled before.
+        """
+
+        def run():
+            with self.pending_lock:
+                if self.pending.pop(rpc_id, None) is None:
+                    return
+            answer()
+
+        timer = threading.Timer(delay, run)
+        timer.daemon = True
+        with self.pending_lock:
+            self.pending[rpc_id] = timer
+        timer.start()
+
+    def cancel(self, rpc_id, result=None):
+        """
+        Answer a pending request right away, with result or as cancelled.
+        """
+        with self.pending_lock:
+            timer = self.pending.pop(rpc_id, None)
+        if timer is None:
+            return
+        timer.cancel()
+        if result is not None:
+            self.respond(rpc_id, result)
+        else:
+            self.respond(rpc_id, error={"code": -32800, "message": "Request cancelled"})
+
+    def candidates(self, params, count):
+        position = params["doc"]["position"]
+        line_start = {"line": position["line"], "character": 0}
+        return [{
+            "uuid": str(uuid.uuid4()),
+            "text": f"{i}{self.completion_text}",
+            "displayText": f"{i}{self.completion_text}",
+            "position": position,
+            "range": {"start": line_start, "end": position},
+        } for i in range(count)]
+
+    def get_completions(self, rpc_id, params, count):
+        self.completions += 1
+        if self.completions == self.args.exit_after:
+            # simulate a crash of agent.js
+            self.stdout.flush()
+            os._exit(1)
+        if self.completions == self.args.hang_after:
+            # simulate a stuck agent.js: nothing is answered any more
+            self.hung = True
+            return
+        if "source" not in params["doc"] and params["doc"]["uri"] not in self.documents:
+            self.respond(rpc_id, error={"code": -32602,
+                                        "message": f"Couldn't find document for uri: {params['doc']['uri']}"})
+            return
+        if self.args.supersede and self.latest_completion is not None:
+            # like agent.js, a new completion cancels the one in progress, which gets no candidates
+            self.cancel(self.latest_completion, {"completions": []})
+        self.latest_completion = rpc_id
+        self.later(rpc_id, self.latency(), lambda: self.respond(rpc_id, {"completions": self.candidates(params, count)}))
+
+    def get_panel_completions(self, rpc_id, params):
+        panel_id = params["panelId"]
+        count = self.args.panel_solutions
+        self.latest_panel = panel_id
+        self.respond(rpc_id, {"solutionCountTarget": count})
+
+        def solution(i):
+            if self.args.supersede and self.latest_panel != panel_id:
+                return
+            if i == count:
+                self.notify("PanelSolutionsDone", {"status": "OK", "panelId": panel_id})
+                return
+            candidate = self.candidates(params, 1)[0]
+            self.notify("PanelSolution", {
+                "panelId": panel_id,
+                "range": candidate["range"],
+                "completionText": candidate["text"],
+                "displayText": candidate["displayText"],
+                "score": random.random(),
+                "solutionId": f"{panel_id}/{i}",
+            })
+            timer = threading.Timer(self.latency(), solution, (i + 1,))
+            timer.daemon = True
+            timer.start()
+
+        solution(0)
+
+    def handle(self, message):
+        if self.hung:
+            return
+        method = message.get("method")
+        rpc_id = message.get("id")
+        params = message.get("params") or {}
+        if method is None:
+            # a response to a request of ours
+            return
+        if method == "initialize":
+            self.respond(rpc_id, {"capabilities": {"workspace": {"workspaceFolders": {"supported": True,
+                                                                                        "changeNotifications": True}}}})
+        elif method == "shutdown":
+            self.respond(rpc_id, None)
+        elif method == "exit":
+            sys.exit(0)
+        elif method == "$/cancelRequest":
+            self.cancel(params.get("id"))
+        elif method == "getCompletions":
+            self.get_completions(rpc_id, params, 1)
+        elif method == "getCompletionsCycling":
+            self.get_completions(rpc_id, params, 3)
+        elif method == "getPanelCompletions":
+            self.get_panel_completions(rpc_id, params)
+        elif method == "checkStatus":
+            self.respond(rpc_id, {"status": "OK" if self.signed_in else "NotSignedIn", "user": "stub"})
+        elif method == "signInInitiate":
+            self.respond(rpc_id, {"status": "PromptUserDeviceFlow", "userCode": "STUB-CODE",
+                                  "verificationUri": "https://github.com/login/device", "expiresIn": 900,
+                                  "interval": 5})
+        elif method == "signInConfirm":
+            self.signed_in = True
+            self.respond(rpc_id, {"status": "OK", "user": "stub"})
+        elif method == "signOut":
+            self.signed_in = False
+            self.respond(rpc_id, {"status": "NotSignedIn"})
+        elif method == "textDocument/didOpen":
+            self.documents[params["textDocument"]["uri"]] = params["textDocument"]
+        elif method == "textDocument/didChange":
+            document = self.documents.get(params["textDocument"]["uri"])
+            if document is not None:
+                document["version"] = params["textDocument"]["version"]
+        elif method == "textDocument/didClose":
+            self.documents.pop(params["textDocument"]["uri"], None)
+        elif rpc_id is not None:
+            if method in ("setEditorInfo", "notifyShown", "notifyAccepted", "notifyRejected"):
+                self.respond(rpc_id, "OK")
+            else:
+                self.respond(rpc_id, error={"code": -32601, "message": f"Method not found: {method}"})
+        if method == "initialized" and self.args.log_messages:
+            self.notify("LogMessage", {"level": 3, "message": "stub agent initialized"})
+
+    def run(self):
+        buffer = bytearray()
+        while True:
+            header_end = buffer.find(b"\r\n\r\n")
+            if header_end >= 0:
+                size = None
+                for line in bytes(buffer[:header_end]).split(b"\r\n"):
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        size = int(value)
+                body_end = header_end + 4 + size
+                if len(buffer) >= body_end:
+                    message = json.loads(buffer[header_end + 4:body_end])
+                    del buffer[:body_end]
+                    self.handle(message)
+                    continue
+            data = self.stdin.read1(1 << 16)
+            if not data:
+                return
+            buffer += data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds before answering a code completion (default: 0)")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="random variation of the latency, in seconds (default: 0)")
+    parser.add_argument("--completion-size", type=int, default=64,
+                        help="the number of characters of each completion text (default: 64)")
+    parser.add_argument("--panel-solutions", type=int, default=10,
+                        help="the number of solutions of getPanelCompletions (default: 10)")
+    parser.add_argument("--supersede", action="store_true",
+                        help="like agent.js, cancel the code completion in progress when a new one is requested")
+    parser.add_argument("--log-messages", action="store_true",
+                        help="send a LogMessage notification after initialization")
+    parser.add_argument("--exit-after", type=int, default=0,
+                        help="exit abruptly on the N-th code completion request, like a crash (default: never)")
+    parser.add_argument("--hang-after", type=int, default=0,
+                        help="stop answering from the N-th code completion request on (default: never)")
+    StubAgent(parser.parse_args()).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,460 @@
+"""
+Share Copilot LSP servers between processes.
+
+The broker owns the Copilot LSP servers and serves code completions to any number of local processes over a Unix
+domain socket, with the same Content-Length framed JSON RPC messages as the Copilot LSP server itself. Processes use
+CopilotBrokerClient, which has the API of CopilotService, instead of launching their own Copilot LSP server. The number
+of Copilot LSP servers is then set by --workers, whatever the number of client processes.
+
+    python broker.py --root ~/src/project --socket /tmp/copilot.sock --workers 4
+"""
+import argparse
+import os
+import shlex
+import signal
+import socket
+import socketserver
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+import pylspclient
+from pylspclient.lsp_structs import ErrorCodes, ResponseError
+
+from admission import AdmissionRejected
+from batch import iter_completions
+from debounce import DocumentDebouncer
+from model import CompletionRequestParams, CompletionResponse
+from pool import CopilotServicePool
+from supervisor import SupervisedCopilotService
+
+
+def params_to_wire(completion_request_params: CompletionRequestParams) -> dict:
+    """
+    The fields of CompletionRequestParams sent to the broker. The source code of a SyncedCompletionRequestParams is
+    sent as is, since synced documents belong to the process that opened them.
+    """
+    return {
+        "docFile": completion_request_params.doc_file,
+        "languageId": completion_request_params.language_id,
+        "position": completion_request_params.position,
+        "insertSpaces": completion_request_params.insert_spaces,
+        "tabSize": completion_request_params.tab_size,
+        "indentSize": completion_request_params.indent_size,
+        "source": completion_request_params.source,
+    }
+
+
+def params_from_wire(params: dict) -> CompletionRequestParams:
+    return CompletionRequestParams(params["docFile"], params["languageId"], params["position"],
+                                   params.get("insertSpaces", True), params.get("tabSize", 4),
+                                   params.get("indentSize", 4), params.get("source"))
+
+
+def _str_keys(value):
+    """
+    A copy of a value whose dict keys are all strings, e.g. the float bucket bounds of the metrics, which JSON objects
+    cannot have as keys.
+    """
+    if isinstance(value, dict):
+        return {key if isinstance(key, str) else str(key): _str_keys(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_str_keys(item) for item in value]
+    return value
+
+
+def _error(e: BaseException) -> dict:
+    """
+    The JSON RPC error of an exception raised by the service. The type of the exception is sent along, so that the
+    client raises the same kind of exception.
+    """
+    if isinstance(e, ResponseError):
+        code = e.code.value if isinstance(e.code, ErrorCodes) else e.code
+        return {"code": code, "message": e.message, "data": getattr(e, "data", None)}
+    data = {"type": type(e).__name__}
+    if isinstance(e, AdmissionRejected):
+        data["reason"] = e.reason
+    return {"code": ErrorCodes.InternalError.value, "message": str(e), "data": data}
+
+
+class _Connection(object):
+    """
+    The requests of one client process in progress on the broker.
+    """
+
+    def __init__(self, endpoint: pylspclient.JsonRpcEndpoint):
+        self.endpoint = endpoint
+        # rpc id -> Future of the service
+        self.requests: Dict[object, Future] = {}
+        # rpc ids handed to the executor, whose Future is not registered yet
+        self.submitted: Set[object] = set()
+        # rpc ids cancelled before their Future was registered
+        self.cancelled: Set[object] = set()
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def submit(self, rpc_id):
+        with self.lock:
+            self.submitted.add(rpc_id)
+
+    def register(self, rpc_id, future: Future):
+        with self.lock:
+            cancelled = self.closed or rpc_id in self.cancelled
+            self.submitted.discard(rpc_id)
+            self.cancelled.discard(rpc_id)
+            if not cancelled:
+                self.requests[rpc_id] = future
+        if cancelled:
+            future.cancel()
+
+    def cancel(self, rpc_id):
+        with self.lock:
+            future = self.requests.pop(rpc_id, None)
+            # a request already answered is not remembered: clients cancel the requests they stopped waiting for
+            if future is None and rpc_id in self.submitted:
+                self.cancelled.add(rpc_id)
+        if future is not None:
+            future.cancel()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            requests, self.requests = self.requests, {}
+            self.submitted.clear()
+            self.cancelled.clear()
+        for future in requests.values():
+            future.cancel()
+
+    def respond(self, rpc_id, result=None, error: BaseException = None):
+        with self.lock:
+            self.requests.pop(rpc_id, None)
+            self.submitted.discard(rpc_id)
+            self.cancelled.discard(rpc_id)
+            if self.closed:
+                return
+        message = {"jsonrpc": "2.0", "id": rpc_id}
+        if error is not None:
+            message["error"] = _error(error)
+        else:
+            message["result"] = result
+        try:
+            self.endpoint.send_request(message)
+        except OSError:
+            # the client is gone
+            pass
+        except (TypeError, ValueError) as e:
+            # a result that cannot be encoded in JSON
+            if error is None:
+                self.respond(rpc_id, error=e)
+
+
+class _BrokerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.broker.serve_connection(self.rfile, self.wfile)
+
+
+class CompletionBroker(object):
+    """
+    Serves code completions of a Copilot service to local processes over a Unix domain socket.
+
+    Each connection sends JSON RPC requests with Content-Length framing, as CopilotBrokerClient does. Requests are
+    answered as they finish, in any order, and $/cancelRequest cancels a request on the service. The requests of a
+    connection are cancelled when it is closed.
+    """
+
+    def __init__(self, service, socket_path: str, mode: int = 0o600, max_workers: int = 32):
+        """
+        :param service: the CopilotService, CopilotServicePool or SupervisedCopilotService serving the requests
+        :param socket_path: the path of the Unix domain socket. A stale socket file left by a broker that is gone is
+                            replaced.
+        :param mode: the permissions of the socket file
+        :param max_workers: the maximum number of requests being handed to the service at a time. Requests waiting
+                            for admission control hold a worker.
+        """
+        self.service = service
+        self.socket_path = socket_path
+        self.connections = 0
+        self._methods: Dict[str, Callable[[dict], object]] = {
+            "signedIn": lambda params: self.service.signed_in(),
+            "signOut": lambda params: self.service.sign_out(),
+            "addWorkspaceFolder": lambda params: self.service.add_workspace_folder(params["path"],
+                                                                                   params.get("name")),
+            "removeWorkspaceFolder": lambda params: self.service.remove_workspace_folder(params["path"]),
+            "metrics": lambda params: _str_keys(self.metrics_snapshot()),
+        }
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._lock = threading.Lock()
+
+        self._remove_stale_socket()
+        self._server = socketserver.ThreadingUnixStreamServer(socket_path, _BrokerRequestHandler)
+        self._server.daemon_threads = True
+        self._server.broker = self
+        os.chmod(socket_path, mode)
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except ConnectionRefusedError:
+            os.unlink(self.socket_path)
+            return
+        finally:
+            probe.close()
+        raise Exception(f"A broker is already listening on {self.socket_path}")
+
+    def metrics_snapshot(self) -> List[dict]:
+        """
+        The metrics of the Copilot services of the broker.
+        """
+        if hasattr(self.service, "metrics_snapshot"):
+            return self.service.metrics_snapshot()
+        return [self.service.metrics.snapshot()]
+
+    def serve_forever(self):
+        """
+        Serve connections until shutdown() is called.
+        """
+        self._server.serve_forever()
+
+    def start(self) -> threading.Thread:
+        """
+        Serve connections in a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        """
+        Stop serving connections and remove the socket file. The service is not shut down.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._executor.shutdown(wait=False)
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def serve_connection(self, rfile, wfile):
+        """
+        Serve the requests of one client process until it disconnects.
+        """
+        connection = _Connection(pylspclient.JsonRpcEndpoint(wfile, rfile))
+        with self._lock:
+            self.connections += 1
+        try:
+            while True:
+                message = connection.endpoint.recv_response()
+                if message is None:
+                    break
+                method = message.get("method")
+                rpc_id = message.get("id")
+                params = message.get("params") or {}
+                if method == "$/cancelRequest":
+                    connection.cancel(params.get("id"))
+                elif method is not None and rpc_id is not None:
+                    connection.submit(rpc_id)
+                    self._executor.submit(self._call, connection, rpc_id, method, params)
+        except (OSError, ValueError, ResponseError):
+            # a broken connection or a client that does not speak JSON RPC
+            pass
+        finally:
+            connection.close()
+            with self._lock:
+                self.connections -= 1
+
+    def _call(self, connection: _Connection, rpc_id, method: str, params: dict):
+        try:
+            if method == "getCompletions":
+                future = self.service.get_completions_async(params_from_wire(params["params"]), params.get("key"))
+                connection.register(rpc_id, future)
+                future.add_done_callback(lambda f: self._finished(connection, rpc_id, f))
+                return
+            handler = self._methods.get(method)
+            if handler is None:
+                raise ResponseError(ErrorCodes.MethodNotFound, f"Unknown method {method}")
+            result = handler(params)
+        except Exception as e:
+            connection.respond(rpc_id, error=e)
+            return
+        connection.respond(rpc_id, result)
+
+    @staticmethod
+    def _finished(connection: _Connection, rpc_id, future: Future):
+        if future.cancelled():
+            connection.respond(rpc_id, error=ResponseError(ErrorCodes.RequestCancelled, "The request was cancelled"))
+        elif future.exception() is not None:
+            connection.respond(rpc_id, error=future.exception())
+        else:
+            connection.respond(rpc_id, future.result())
+
+
+class _BrokerEndpoint(pylspclient.LspEndpoint):
+    """
+    Raises the exceptions the service raised on the broker.
+    """
+
+    _EXCEPTIONS = {
+        "TimeoutError": TimeoutError,
+        "EOFError": EOFError,
+        "BrokenPipeError": EOFError,
+        "ValueError": ValueError,
+    }
+
+    def response_error(self, error) -> Exception:
+        data = error.get("data") or {}
+        exception_type = data.get("type") if isinstance(data, dict) else None
+        if exception_type == "AdmissionRejected":
+            return AdmissionRejected(data.get("reason"), error.get("message"))
+        if exception_type in self._EXCEPTIONS:
+            return self._EXCEPTIONS[exception_type](error.get("message"))
+        return super().response_error(error)
+
+
+class CopilotBrokerClient(object):
+    """
+    A client of a CompletionBroker, with the API of CopilotService. Any number of processes share the Copilot LSP
+    servers of the broker instead of each launching its own.
+    """
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = 10):
+        """
+        Connect to a broker.
+        :param socket_path: the path of the Unix domain socket of the broker
+        :param timeout: the default number of seconds to wait for code completions, None to wait forever
+        """
+        self.socket_path = socket_path
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path)
+        self.metrics = pylspclient.Metrics()
+        json_rpc_endpoint = pylspclient.JsonRpcEndpoint(self.socket.makefile("wb"), self.socket.makefile("rb"),
+                                                        self.metrics)
+        self.lsp_endpoint = _BrokerEndpoint(json_rpc_endpoint, timeout=timeout, metrics=self.metrics)
+        self.lsp_endpoint.daemon = True
+        self.lsp_endpoint.start()
+        self._debouncer = DocumentDebouncer(self.get_completions_async)
+
+    def shutdown(self):
+        """
+        Disconnect from the broker. Requests in progress are cancelled; the broker keeps running.
+        """
+        self.lsp_endpoint.stop()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        self.lsp_endpoint.join()
+
+    def get_completions(self, completion_request_params: CompletionRequestParams,
+                        timeout: float = None, key: str = None) -> CompletionResponse:
+        """
+        Get code completions. See CopilotService.get_completions.
+        """
+        future = self.get_completions_async(completion_request_params, key)
+        if timeout is None:
+            return self.lsp_endpoint.wait_for(future)
+        return self.lsp_endpoint.wait_for(future, timeout)
+
+    def get_completions_async(self, completion_request_params: CompletionRequestParams, key: str = None) -> Future:
+        """
+        Get code completions without waiting for them. See CopilotService.get_completions_async.
+        :return: a Future of the CompletionResponse object. Cancelling the Future cancels the request on the broker.
+        """
+        return self.lsp_endpoint.call_method_async("getCompletions", params=params_to_wire(completion_request_params),
+                                                   key=key)
+
+    def get_completions_latest_async(self, completion_request_params: CompletionRequestParams,
+                                     delay: float = 0.0) -> Future:
+        """
+        Get code completions for the newest request of a document only.
+        See CopilotService.get_completions_latest_async.
+        """
+        return self._debouncer.request(completion_request_params, delay)
+
+    def get_completions_latest(self, completion_request_params: CompletionRequestParams, delay: float = 0.0,
+                               timeout: float = None) -> Optional[CompletionResponse]:
+        """
+        Get code completions for the newest request of a document only. See CopilotService.get_completions_latest.
+        """
+        timeout = timeout if timeout is not None else self.lsp_endpoint._timeout
+        return self._debouncer.wait(self.get_completions_latest_async(completion_request_params, delay),
+                                    None if timeout is None else timeout + delay)
+
+    def get_completions_batch(self, params_iterable: Iterable[CompletionRequestParams], max_in_flight: int = 1
+                              ) -> Iterator[Tuple[CompletionRequestParams, Union[CompletionResponse, Exception]]]:
+        """
+        Get code completions for many requests, yielding the results as they finish.
+        See CopilotService.get_completions_batch. max_in_flight above 1 is useful when the broker runs several
+        Copilot LSP servers.
+        """
+        return iter_completions(self.get_completions_async, params_iterable, max_in_flight, self.lsp_endpoint._timeout)
+
+    def add_workspace_folder(self, path: str, name: str = None):
+        """
+        Add a workspace folder to the Copilot LSP servers of the broker. See CopilotService.add_workspace_folder.
+        """
+        self.lsp_endpoint.call_method("addWorkspaceFolder", path=path, name=name)
+
+    def remove_workspace_folder(self, path: str):
+        """
+        Remove a workspace folder from the Copilot LSP servers of the broker.
+        """
+        self.lsp_endpoint.call_method("removeWorkspaceFolder", path=path)
+
+    def metrics_snapshot(self) -> List[dict]:
+        """
+        The metrics of the Copilot services of the broker. The metrics of this client are in metrics.
+        """
+        return self.lsp_endpoint.call_method("metrics")
+
+    def sign_out(self):
+        """
+        Sign out the current user of Copilot. Signing in is done on the broker, e.g. with CopilotService.sign_in().
+        """
+        self.lsp_endpoint.call_method("signOut")
+
+    def signed_in(self) -> bool:
+        """
+        Check if a user is signed in to Copilot on the broker.
+        """
+        return self.lsp_endpoint.call_method("signedIn")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--socket", required=True, help="the path of the Unix domain socket")
+    parser.add_argument("--root", required=True, help="the root directory of the Copilot LSP servers")
+    parser.add_argument("--workspace-folder", action="append", default=[],
+                        help="another workspace folder, can be repeated")
+    parser.add_argument("--workers", type=int, default=1, help="the number of Copilot LSP servers (default: 1)")
+    parser.add_argument("--copilot-agent-path", help="the path to the Copilot LSP server (agent.js)")
+    parser.add_argument("--agent-command", help="the command line that launches each LSP server instead of agent.js")
+    args = parser.parse_args()
+
+    agent_command = shlex.split(args.agent_command) if args.agent_command else None
+    # a long-running broker restarts the Copilot LSP servers that crash, whatever the number of workers
+    if args.workers > 1:
+        service = CopilotServicePool(args.root, args.workers, args.copilot_agent_path, agent_command=agent_command,
+                                     supervised=True)
+    else:
+        service = SupervisedCopilotService(args.root, args.copilot_agent_path, agent_command=agent_command)
+    for folder in args.workspace_folder:
+        service.add_workspace_folder(folder)
+
+    broker = CompletionBroker(service, args.socket)
+    # shutdown() waits for serve_forever() to return, so it cannot run on the thread serving
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=broker.shutdown).start())
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        broker.shutdown()
+    finally:
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    main()
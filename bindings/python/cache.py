@@ -0,0 +1,244 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import pylspclient
+from model import CompletionResponse
+
+
+class CompletionCache(object):
+    """
+    Thread safe in-memory cache of code completions, with a bounded size, least-recently-used eviction and a
+    time-to-live per entry.
+
+    The keys are the content hashes given by CompletionRequestParams.cache_key(). The cached CompletionResponse
+    objects are shared by everyone getting them from the cache, so they must not be modified.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = 300):
+        """
+        :param max_size: the maximum number of cached responses
+        :param ttl: the number of seconds a response stays in the cache. None to keep responses until evicted.
+        """
+        if max_size < 1:
+            raise ValueError(f"Invalid cache size: {max_size}")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[CompletionResponse]:
+        """
+        Look up a response.
+        :param key: the cache key of the request
+        :return: the cached response, or None if it is not cached or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, response = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return response
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, response: CompletionResponse):
+        """
+        Cache a response, evicting the least recently used responses beyond max_size.
+        :param key: the cache key of the request
+        :param response: the response to the request
+        """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all responses from the cache. The counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteCompletionCache(object):
+    """
+    Persistent cache of code completions in a SQLite database, shared by runs and by processes. It has the interface
+    of CompletionCache.
+
+    The database is in WAL mode, so any number of processes read it while one writes, and writers wait for each other
+    for up to busy_timeout seconds. Each thread uses its own connection. The total size of the cached responses is
+    bounded by max_bytes: once it is exceeded, the least recently used responses are evicted down to 90% of
+    max_bytes. The last access time is only written when it is more than access_resolution seconds old, so repeated
+    hits do not turn readers into writers.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024, ttl: Optional[float] = None,
+                 busy_timeout: float = 30.0, access_resolution: float = 60.0):
+        """
+        :param path: the path of the database file. It is created if it does not exist.
+        :param max_bytes: the maximum total size in bytes of the cached responses
+        :param ttl: the number of seconds a response stays in the cache. None to keep responses until evicted.
+        :param busy_timeout: the number of seconds to wait for another process writing to the database
+        :param access_resolution: the number of seconds between two updates of the last access time of a response
+        """
+        if max_bytes < 1:
+            raise ValueError(f"Invalid cache size: {max_bytes}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.busy_timeout = busy_timeout
+        self.access_resolution = access_resolution
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+        self._counters_lock = threading.Lock()
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, response BLOB NOT NULL, "
+                               "size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+            connection.execute("CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                               "bytes INTEGER NOT NULL)")
+            connection.execute("INSERT OR IGNORE INTO total VALUES (0, 0)")
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        The connection of the current thread, opened again in a forked process.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _count(self, counter: str, n: int = 1):
+        with self._counters_lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    @property
+    def total_bytes(self) -> int:
+        """
+        The total size in bytes of the cached responses.
+        """
+        return self._connection().execute("SELECT bytes FROM total").fetchone()[0]
+
+    def get(self, key: str) -> Optional[CompletionResponse]:
+        """
+        Look up a response.
+        :param key: the cache key of the request
+        :return: the cached response, or None if it is not cached or expired
+        """
+        connection = self._connection()
+        row = connection.execute("SELECT response, created, accessed FROM completions WHERE key = ?",
+                                 (key,)).fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+        response, created, accessed = row
+        now = time.time()
+        if self.ttl is not None and created + self.ttl <= now:
+            self._delete(connection, key)
+            self._count("misses")
+            return None
+        if now - accessed > self.access_resolution:
+            connection.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+        self._count("hits")
+        return pylspclient.json_rpc_endpoint.loads(response)
+
+    @staticmethod
+    def _delete(connection: sqlite3.Connection, key: str):
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+                connection.execute("UPDATE total SET bytes = bytes - ?", row)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def put(self, key: str, response: CompletionResponse):
+        """
+        Cache a response, evicting the least recently used responses beyond max_bytes.
+        :param key: the cache key of the request
+        :param response: the response to the request
+        """
+        data = pylspclient.json_rpc_endpoint.dumps(response)
+        now = time.time()
+        connection = self._connection()
+        evicted = 0
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+            old_size = row[0] if row is not None else 0
+            connection.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                               (key, data, len(data), now, now))
+            connection.execute("UPDATE total SET bytes = bytes + ?", (len(data) - old_size,))
+            total = connection.execute("SELECT bytes FROM total").fetchone()[0]
+            if total > self.max_bytes:
+                target = total - self.max_bytes * 9 // 10
+                freed = 0
+                keys = []
+                cursor = connection.execute("SELECT key, size FROM completions WHERE key != ? ORDER BY accessed",
+                                            (key,))
+                for old_key, size in cursor:
+                    if freed >= target:
+                        break
+                    keys.append((old_key,))
+                    freed += size
+                cursor.close()
+                connection.executemany("DELETE FROM completions WHERE key = ?", keys)
+                connection.execute("UPDATE total SET bytes = bytes - ?", (freed,))
+                evicted = len(keys)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if evicted:
+            self._count("evictions", evicted)
+
+    def clear(self):
+        """
+        Remove all responses from the cache. The counters are kept.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM completions")
+            connection.execute("UPDATE total SET bytes = 0")
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        """
+        Close the connection of the current thread. The cache can still be used; it connects again.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
@@ -0,0 +1,239 @@
+import os
+import pathlib
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from document import SyncedDocument
+from model import CompletionRequestParams, CompletionResponse, LANGUAGE_IDS
+
+_PYTHON_IMPORT = re.compile(r"^\s*(?:from\s+(\.*)([\w.]*)\s+import|import\s+([\w.]+))", re.MULTILINE)
+_JS_IMPORT = re.compile(r"""(?:\bfrom\s+|\brequire\(\s*|\bimport\s*\(\s*|^\s*import\s+)['"](\.{1,2}/[^'"]+)['"]""",
+                        re.MULTILINE)
+_JS_SUFFIXES = ("", ".ts", ".tsx", ".js", ".jsx", "/index.ts", "/index.tsx", "/index.js", "/index.jsx")
+
+
+class _OpenNeighbor(object):
+    def __init__(self, document: SyncedDocument, size: int, mtime: Optional[float]):
+        self.document = document
+        self.size = size
+        self.mtime = mtime
+
+
+class NeighborContext(object):
+    """
+    A bounded working set of documents kept open on the Copilot LSP server, so that code completions see the files
+    related to the requested one. The Copilot LSP server uses the open documents of the same language as extra
+    context for its prompts.
+
+    Before each request, the requested file and its neighbors are opened (or marked as recently used): the local
+    modules it imports first, then the other files of its directory with the same extension. The least recently used
+    documents are closed with textDocument/didClose when the working set exceeds max_documents or max_bytes.
+    Documents opened by other means with CopilotService.open_document() are left alone.
+    """
+
+    def __init__(self, service, max_bytes: int = 2 * 1024 * 1024, max_documents: int = 32,
+                 max_neighbors: int = 8, max_file_size: int = 256 * 1024):
+        """
+        :param service: the CopilotService the documents are opened on
+        :param max_bytes: the maximum total size in bytes of the open documents
+        :param max_documents: the maximum number of open documents
+        :param max_neighbors: the maximum number of neighbors opened for a request
+        :param max_file_size: the size in bytes above which a file is not opened
+        """
+        self.service = service
+        self.max_bytes = max_bytes
+        self.max_documents = max_documents
+        self.max_neighbors = max_neighbors
+        self.max_file_size = max_file_size
+        self.total_bytes = 0
+        self.opened = 0
+        self.evicted = 0
+        # path -> _OpenNeighbor, least recently used first
+        self._open: "OrderedDict[str, _OpenNeighbor]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._open)
+
+    def _in_root(self, path: str) -> bool:
+        return self.service.workspace.root_of(path) is not None
+
+    def _python_imports(self, doc_file: str, source: str) -> List[str]:
+        directory = os.path.dirname(doc_file)
+        root = self.service.workspace.root_of(doc_file)
+        paths = []
+        for dots, from_module, module in _PYTHON_IMPORT.findall(source):
+            if dots:
+                base = directory
+                for _ in range(len(dots) - 1):
+                    base = os.path.dirname(base)
+                bases = [base]
+                module = from_module
+            else:
+                bases = [directory] if root is None else [directory, os.path.abspath(root)]
+                module = from_module or module
+            relative = module.replace(".", os.sep)
+            for base in bases:
+                paths.append(os.path.join(base, relative + ".py") if relative else os.path.join(base, "__init__.py"))
+                if relative:
+                    paths.append(os.path.join(base, relative, "__init__.py"))
+        return paths
+
+    @staticmethod
+    def _js_imports(doc_file: str, source: str) -> List[str]:
+        directory = os.path.dirname(doc_file)
+        return [os.path.normpath(os.path.join(directory, module)) + suffix
+                for module in _JS_IMPORT.findall(source) for suffix in _JS_SUFFIXES]
+
+    def neighbors(self, doc_file: str, source: str) -> List[str]:
+        """
+        The files related to a source code file, most relevant first: the local modules it imports, then the files
+        of its directory with the same extension, most recently modified first.
+        :param doc_file: the absolute path of the source code file
+        :param source: the source code
+        :return: the absolute paths of at most max_neighbors existing files in the workspace folders
+        """
+        extension = os.path.splitext(doc_file)[1].lower()
+        if extension == ".py":
+            candidates = self._python_imports(doc_file, source)
+        elif extension in (".js", ".jsx", ".ts", ".tsx"):
+            candidates = self._js_imports(doc_file, source)
+        else:
+            candidates = []
+
+        directory = os.path.dirname(doc_file)
+        try:
+            siblings = [entry for entry in os.scandir(directory)
+                        if entry.is_file() and os.path.splitext(entry.name)[1].lower() == extension]
+            siblings.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+            candidates.extend(entry.path for entry in siblings)
+        except OSError:
+            pass
+
+        neighbors = []
+        for path in candidates:
+            path = os.path.abspath(path)
+            if path == doc_file or path in neighbors or not self._in_root(path) or not os.path.isfile(path):
+                continue
+            neighbors.append(path)
+            if len(neighbors) >= self.max_neighbors:
+                break
+        return neighbors
+
+    def _touch(self, path: str, text: str = None):
+        """
+        Open a document, or mark it as recently used, updating it if the file changed on disk.
+        """
+        language_id = LANGUAGE_IDS.get(os.path.splitext(path)[1].lower())
+        if language_id is None:
+            return
+        mtime = None
+        if text is None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return
+            if stat.st_size > self.max_file_size:
+                return
+            mtime = stat.st_mtime
+
+        neighbor = self._open.get(path)
+        if neighbor is not None and not neighbor.document.closed:
+            self._open.move_to_end(path)
+            if (text is not None and text != neighbor.document.text) or (mtime is not None and mtime != neighbor.mtime):
+                if text is None:
+                    try:
+                        with open(path, encoding="utf-8", errors="replace") as f:
+                            text = f.read()
+                    except OSError:
+                        return
+                neighbor.document.replace(text)
+                self.total_bytes += len(text.encode("utf-8")) - neighbor.size
+                neighbor.size = len(text.encode("utf-8"))
+                neighbor.mtime = mtime
+            return
+        if neighbor is not None:
+            # closed by someone else
+            del self._open[path]
+            self.total_bytes -= neighbor.size
+
+        uri = pathlib.Path(path).as_uri()
+        if uri in self.service.documents and not self.service.documents[uri].closed:
+            # opened by someone else
+            return
+        if text is None:
+            try:
+                with open(path, encoding="utf-8", errors="replace") as f:
+                    text = f.read()
+            except OSError:
+                return
+        size = len(text.encode("utf-8"))
+        if size > self.max_file_size:
+            return
+        document = self.service.open_document(path, language_id, text)
+        self._open[path] = _OpenNeighbor(document, size, mtime)
+        self.total_bytes += size
+        self.opened += 1
+
+    def _evict(self, keep: int):
+        """
+        Close the least recently used documents until the working set fits, never closing the keep most recent ones.
+        """
+        while len(self._open) > keep and (len(self._open) > self.max_documents or self.total_bytes > self.max_bytes):
+            path, neighbor = self._open.popitem(last=False)
+            self.total_bytes -= neighbor.size
+            self.service.close_document(neighbor.document)
+            self.evicted += 1
+
+    def prepare(self, completion_request_params: CompletionRequestParams):
+        """
+        Open the requested file and its neighbors on the Copilot LSP server, and close the least recently used
+        documents beyond the budget.
+        :param completion_request_params: the params of the code completion request about to be sent
+        """
+        doc_file = os.path.abspath(completion_request_params.doc_file)
+        if not self._in_root(doc_file):
+            return
+        source = completion_request_params.source
+        if source is None:
+            try:
+                with open(doc_file, encoding="utf-8", errors="replace") as f:
+                    source = f.read()
+            except OSError:
+                return
+        with self._lock:
+            neighbors = self.neighbors(doc_file, source)
+            for path in reversed(neighbors):
+                self._touch(path)
+            if completion_request_params.source is not None:
+                self._touch(doc_file, source)
+            else:
+                self._touch(doc_file)
+            # the requested file and its neighbors are the most recently used documents
+            self._evict(1)
+
+    def get_completions(self, completion_request_params: CompletionRequestParams,
+                        timeout: float = None, key: str = None) -> CompletionResponse:
+        """
+        Get code completions with the neighbors of the requested file open. See CopilotService.get_completions.
+        """
+        self.prepare(completion_request_params)
+        return self.service.get_completions(completion_request_params, timeout, key)
+
+    def close(self):
+        """
+        Close all the documents opened by this context.
+        """
+        with self._lock:
+            while self._open:
+                _, neighbor = self._open.popitem(last=False)
+                self.service.close_document(neighbor.document)
+            self.total_bytes = 0
@@ -0,0 +1,117 @@
+import threading
+from concurrent.futures import Future, CancelledError
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, Optional
+
+from model import CompletionRequestParams, CompletionResponse
+
+
+class _PendingCompletion(object):
+    def __init__(self, params: CompletionRequestParams):
+        self.params = params
+        self.future = Future()
+        self.timer: Optional[threading.Timer] = None
+        self.request: Optional[Future] = None
+
+
+class DocumentDebouncer(object):
+    """
+    Latest-wins code completion requests per document, for editors that ask for code completions on every keystroke.
+
+    Only the newest request of each document is kept: a new request for a document cancels the previous one, whether
+    it is still waiting for its quiet period or already sent to the Copilot LSP server. A request is sent once no newer
+    request for its document arrived during its quiet period.
+    """
+
+    def __init__(self, submit: Callable[[CompletionRequestParams], Future], delay: float = 0.0):
+        """
+        :param submit: sends a code completion request and returns the Future of its response
+        :param delay: the default quiet period in seconds before a request is sent
+        """
+        self.submit = submit
+        self.delay = delay
+        self.superseded = 0
+        self._latest: Dict[str, _PendingCompletion] = {}
+        self._lock = threading.Lock()
+
+    def request(self, completion_request_params: CompletionRequestParams, delay: float = None) -> Future:
+        """
+        Request code completions, superseding the previous request for the same document.
+        :param completion_request_params: the params of the code completion request
+        :param delay: optional, the quiet period in seconds before the request is sent. Defaults to the delay of the
+                      debouncer.
+        :return: a Future of the CompletionResponse object. It is cancelled when a newer request for the same document
+                 supersedes it. Cancelling it cancels the request.
+        """
+        pending = _PendingCompletion(completion_request_params)
+        uri = completion_request_params.uri
+        with self._lock:
+            previous = self._latest.get(uri)
+            self._latest[uri] = pending
+        pending.future.add_done_callback(lambda _: self._finished(uri, pending))
+        if previous is not None and previous.future.cancel():
+            self.superseded += 1
+
+        delay = delay if delay is not None else self.delay
+        if delay > 0:
+            pending.timer = threading.Timer(delay, self._send, (uri, pending))
+            pending.timer.daemon = True
+            pending.timer.start()
+        else:
+            self._send(uri, pending)
+        return pending.future
+
+    def _send(self, uri: str, pending: _PendingCompletion):
+        with self._lock:
+            if self._latest.get(uri) is not pending:
+                return
+        try:
+            request = self.submit(pending.params)
+        except Exception as e:
+            if pending.future.set_running_or_notify_cancel():
+                pending.future.set_exception(e)
+            return
+        pending.request = request
+        if pending.future.done():
+            # superseded while it was being sent
+            request.cancel()
+            return
+        request.add_done_callback(lambda _: self._resolve(pending))
+
+    @staticmethod
+    def _resolve(pending: _PendingCompletion):
+        request = pending.request
+        if not pending.future.set_running_or_notify_cancel():
+            return
+        if request.cancelled():
+            pending.future.set_exception(TimeoutError())
+        elif request.exception() is not None:
+            pending.future.set_exception(request.exception())
+        else:
+            pending.future.set_result(request.result())
+
+    def _finished(self, uri: str, pending: _PendingCompletion):
+        with self._lock:
+            if self._latest.get(uri) is pending:
+                del self._latest[uri]
+        if pending.future.cancelled():
+            if pending.timer is not None:
+                pending.timer.cancel()
+            if pending.request is not None:
+                pending.request.cancel()
+
+    @staticmethod
+    def wait(future: Future, timeout: Optional[float]) -> Optional[CompletionResponse]:
+        """
+        Wait for the response of a request.
+        :param future: the Future returned by request()
+        :param timeout: the number of seconds to wait, None to wait forever. The request is cancelled if it times out.
+        :return: the CompletionResponse object, or None if a newer request for the same document superseded it
+        """
+        try:
+            return future.result(timeout)
+        except CancelledError:
+            return None
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError()
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import hashlib
+import pathlib
+import threading
+from typing import Union, List, TYPE_CHECKING
+
+from model import CompletionRequestParams, CompletionRequestPosition, CompletionResponseRange, LineIndex
+
+if TYPE_CHECKING:
+    import pylspclient
+
+
+class SyncedDocument(object):
+    """
+    A text document opened on the Copilot LSP server with textDocument/didOpen and kept up to date with versioned
+    textDocument/didChange notifications. Completion requests for a synced document refer to it by uri instead of
+    sending the whole source code again.
+    """
+
+    def __init__(self, lsp_client: pylspclient.LspClient, doc_file: str, language_id: str,
+                 root_dir: Union[None, str] = None, text: str = None):
+        """
+        Open a document on the Copilot LSP server.
+        :param lsp_client: the client of the Copilot LSP server
+        :param doc_file: the path to the source code file
+        :param language_id: the language id of the source code file
+        :param root_dir: the root directory that relative paths are computed against.
+                         Defaults to the parent directory of doc_file
+        :param text: optional, the content of the document. Defaults to the content of doc_file on disk
+        """
+        self.lsp_client = lsp_client
+        self.doc_file = doc_file
+        self.language_id = language_id
+        path = pathlib.Path(doc_file)
+        self.uri = path.as_uri()
+        self.relative_path = str(path.relative_to(root_dir if root_dir is not None else path.parent))
+        self.text = text if text is not None else path.read_text()
+        self.version = 0
+        self.closed = False
+        self._line_index = None
+        self._lock = threading.Lock()
+        self.lsp_client.didOpen({
+            "uri": self.uri,
+            "languageId": self.language_id,
+            "version": self.version,
+            "text": self.text,
+        })
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError(f"Document {self.doc_file} is closed")
+
+    def _did_change(self, content_changes: List[dict]):
+        self.version += 1
+        self.lsp_client.didChange({"uri": self.uri, "version": self.version}, content_changes)
+
+    @property
+    def line_index(self) -> LineIndex:
+        """
+        The line index of the current content of the document, built once per version.
+        """
+        line_index = self._line_index
+        if line_index is None or line_index.text is not self.text:
+            line_index = self._line_index = LineIndex(self.text)
+        return line_index
+
+    def edit(self, edit_range: CompletionResponseRange, new_text: str) -> int:
+        """
+        Replace a range of the document.
+        :param edit_range: the range of the document to replace. An empty range inserts new_text.
+        :param new_text: the text to put in place of the range
+        :return: the new version of the document
+        """
+        with self._lock:
+            # checked before the content changes, so that a closed document is left as it was
+            self._check_open()
+            self.text = self.line_index.apply_edit(edit_range, new_text)
+            self._did_change([{"range": edit_range, "text": new_text}])
+            return self.version
+
+    def replace(self, text: str) -> int:
+        """
+        Replace the whole content of the document.
+        :param text: the new content of the document
+        :return: the new version of the document
+        """
+        with self._lock:
+            self._check_open()
+            self.text = text
+            self._did_change([{"text": text}])
+            return self.version
+
+    def reopen(self, lsp_client: pylspclient.LspClient):
+        """
+        Open the document again on another Copilot LSP server, e.g. one restarted after a crash, with the current
+        content and version of the document.
+        :param lsp_client: the client of the Copilot LSP server
+        """
+        with self._lock:
+            self.lsp_client = lsp_client
+            self.lsp_client.didOpen({
+                "uri": self.uri,
+                "languageId": self.language_id,
+                "version": self.version,
+                "text": self.text,
+            })
+
+    def close(self):
+        """
+        Close the document on the Copilot LSP server.
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.lsp_client.didClose({"uri": self.uri})
+
+    def completion_params(self, position: CompletionRequestPosition, insert_spaces: bool = True,
+                          tab_size: int = 4, indent_size: int = 4) -> SyncedCompletionRequestParams:
+        """
+        The params of a code completion request at a position of the current version of this document.
+        See CompletionRequestParams for the parameters.
+        """
+        return SyncedCompletionRequestParams(self, position, insert_spaces, tab_size, indent_size)
+
+
+class SyncedCompletionRequestParams(CompletionRequestParams):
+    """
+    The params for the getCompletion request on a SyncedDocument. The source code is not sent with the request,
+    the Copilot LSP server uses the version of the document it was synced to.
+    """
+
+    def __init__(self, document: SyncedDocument, position: CompletionRequestPosition, insert_spaces: bool = True,
+                 tab_size: int = 4, indent_size: int = 4):
+        super().__init__(document.doc_file, document.language_id, position, insert_spaces, tab_size, indent_size,
+                         document.text)
+        self.document = document
+        self.version = document.version
+
+    @property
+    def line_index(self) -> LineIndex:
+        if self._line_index is None and self.document.text is self.source:
+            self._line_index = self.document.line_index
+        return super().line_index
+
+    def to_dict(self, root_dir: Union[None, str] = None) -> dict:
+        return {
+            "doc": {
+                "uri": self.document.uri,
+                "path": self.doc_file,
+                "relativePath": self.document.relative_path,
+                "version": self.version,
+                "position": self.position,
+                "languageId": self.language_id,
+                "insertSpaces": self.insert_spaces,
+                "tabSize": self.tab_size,
+                "indentSize": self.indent_size,
+            },
+            "textDocument": {
+                "uri": self.document.uri,
+                "relativePath": self.document.relative_path,
+                "languageId": self.language_id,
+                "version": self.version,
+            },
+            "position": self.position,
+        }
+
+    def cache_key(self, root_dir: Union[None, str] = None, request: dict = None) -> str:
+        """
+        A content hash of the request, including the source code of the document at the requested version.
+        """
+        digest = hashlib.sha256(super().cache_key(root_dir, request).encode())
+        digest.update(self.source.encode())
+        return digest.hexdigest()
@@ -0,0 +1,266 @@
+"""
+Harvest code completions over a whole repository.
+
+The manifest is a JSONL file with one code completion request per line:
+
+    {"file": "src/app.py", "line": 12, "character": 4}
+
+"file" is relative to the root directory, and an optional "language_id" overrides the language guessed from the file
+extension. The results are appended to the output JSONL file as they arrive, one line per request, with the index of
+the request in the manifest and either its "completions" or its "error". Progress is checkpointed next to the output
+file, so running the same command again after a crash resumes where the previous run stopped. Requests that failed
+for a transient reason, such as a timeout or a crashed Copilot LSP server, are not recorded and are sent again by the
+next run.
+
+    python harvest.py --root ~/src/project manifest.jsonl completions.jsonl --workers 4
+"""
+import argparse
+import functools
+import json
+import os
+import pathlib
+import shlex
+import sys
+import time
+from typing import Iterator, Optional, Set, Tuple, List
+
+import pylspclient
+from admission import AdmissionRejected
+from cache import SqliteCompletionCache
+from model import CompletionRequestParams, LANGUAGE_IDS
+from pool import CopilotServicePool
+
+# failures that say nothing about the request itself: the request is left for the next run instead of being recorded
+TRANSIENT_ERRORS = (EOFError, BrokenPipeError, TimeoutError, AdmissionRejected)
+
+
+class HarvestCheckpoint(object):
+    """
+    The progress of a harvest: every manifest index below next_index is done, as are the indices in done.
+    The checkpoint also records how much of the output file it covers, so resuming only reads the output written
+    after the last checkpoint.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.next_index = 0
+        self.done: Set[int] = set()
+        self.output_offset = 0
+
+    @classmethod
+    def load(cls, path: str, output_path: str) -> "HarvestCheckpoint":
+        """
+        Load the checkpoint of a previous run, and add the results written to the output file after it.
+        A line left incomplete by a crash is cut from the output file.
+        :param path: the checkpoint file
+        :param output_path: the output JSONL file
+        """
+        checkpoint = cls(path)
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            checkpoint.next_index = data["next_index"]
+            checkpoint.done = set(data["done"])
+            checkpoint.output_offset = data["output_offset"]
+        if not os.path.exists(output_path):
+            checkpoint.output_offset = 0
+            return checkpoint
+        with open(output_path, "r+b") as f:
+            f.seek(checkpoint.output_offset)
+            end = checkpoint.output_offset
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    checkpoint.mark(json.loads(line)["index"])
+                except (ValueError, KeyError):
+                    break
+                end += len(line)
+            f.truncate(end)
+        return checkpoint
+
+    def is_done(self, index: int) -> bool:
+        return index < self.next_index or index in self.done
+
+    def mark(self, index: int):
+        self.done.add(index)
+        while self.next_index in self.done:
+            self.done.remove(self.next_index)
+            self.next_index += 1
+
+    def save(self, output_offset: int):
+        """
+        Write the checkpoint atomically.
+        :param output_offset: the size of the output file, which must be flushed before
+        """
+        self.output_offset = output_offset
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"next_index": self.next_index, "done": sorted(self.done), "output_offset": output_offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class Harvester(object):
+    """
+    Requests code completions for every row of a manifest on a pool of supervised Copilot services, so that crashed
+    Copilot LSP servers are restarted.
+    """
+
+    def __init__(self, root_path: str, manifest_path: str, output_path: str, checkpoint_path: str = None,
+                 workers: int = 1, max_in_flight: int = None, checkpoint_every: int = 100,
+                 default_language_id: str = None, copilot_agent_path: str = None, agent_command: List[str] = None,
+                 cache_path: str = None):
+        """
+        :param root_path: the root directory of the repository
+        :param manifest_path: the manifest JSONL file
+        :param output_path: the output JSONL file. Results are appended to it.
+        :param checkpoint_path: optional, the checkpoint file. Defaults to the output file with a .checkpoint suffix
+        :param workers: the number of Copilot LSP servers
+        :param max_in_flight: the maximum number of requests in progress. Defaults to the number of workers
+        :param checkpoint_every: the number of results between two checkpoints
+        :param default_language_id: optional, the language id of the files whose extension is unknown
+        :param copilot_agent_path: optional, the path to the Copilot LSP server (agent.js)
+        :param agent_command: optional, the command line that launches each LSP server. See CopilotService.
+        :param cache_path: optional, the SQLite database of a SqliteCompletionCache, so that requests answered by
+                           earlier harvests are not sent again
+        """
+        self.root_path = os.path.abspath(root_path)
+        self.manifest_path = manifest_path
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path if checkpoint_path is not None else output_path + ".checkpoint"
+        self.workers = workers
+        self.max_in_flight = max_in_flight if max_in_flight is not None else workers
+        self.checkpoint_every = checkpoint_every
+        self.default_language_id = default_language_id
+        self.copilot_agent_path = copilot_agent_path
+        self.agent_command = agent_command
+        self.cache_path = cache_path
+        self.completed = 0
+        self.errors = 0
+        self.unfinished = 0
+        # params of the requests in progress -> (manifest index, manifest row)
+        self._rows = {}
+
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _read_source(path: str) -> str:
+        return pathlib.Path(path).read_text()
+
+    def _language_id(self, row: dict) -> str:
+        language_id = row.get("language_id") or LANGUAGE_IDS.get(os.path.splitext(row["file"])[1].lower(),
+                                                                 self.default_language_id)
+        if language_id is None:
+            raise ValueError(f"Unknown language of {row['file']}, set language_id")
+        return language_id
+
+    def _params(self, checkpoint: HarvestCheckpoint,
+                failed: List[Tuple[int, dict, Exception]]) -> Iterator[CompletionRequestParams]:
+        """
+        The params of the manifest rows that are not done yet. Rows that cannot be turned into params are added to
+        failed instead.
+        """
+        with open(self.manifest_path, "rb") as manifest:
+            for index, line in enumerate(manifest):
+                if checkpoint.is_done(index) or not line.strip():
+                    continue
+                row = None
+                try:
+                    row = json.loads(line)
+                    path = os.path.join(self.root_path, row["file"])
+                    params = CompletionRequestParams.from_source(
+                        self._read_source(path), path, self._language_id(row),
+                        {"line": row["line"], "character": row["character"]})
+                except Exception as e:
+                    failed.append((index, row, e))
+                    continue
+                self._rows[id(params)] = (index, row, params)
+                yield params
+
+    @staticmethod
+    def _record(index: int, row: Optional[dict], response) -> dict:
+        record = {"index": index}
+        if row is not None:
+            record.update(row)
+        if isinstance(response, Exception):
+            record["error"] = f"{type(response).__name__}: {response}"
+        else:
+            record["completions"] = response.get("completions", [])
+        return record
+
+    def run(self, progress=None):
+        """
+        Harvest the code completions of the rows that are not done yet.
+        :param progress: optional, a text file that progress reports are written to
+        """
+        checkpoint = HarvestCheckpoint.load(self.checkpoint_path, self.output_path)
+        failed = []
+        cache = SqliteCompletionCache(self.cache_path) if self.cache_path is not None else None
+        pool = CopilotServicePool(self.root_path, self.workers, self.copilot_agent_path, cache,
+                                  agent_command=self.agent_command, supervised=True)
+        start = time.monotonic()
+        try:
+            with open(self.output_path, "ab") as output:
+                def write(index, row, response):
+                    if isinstance(response, TRANSIENT_ERRORS):
+                        # not marked done: the next run sends it again
+                        self.unfinished += 1
+                        return
+                    output.write(pylspclient.json_rpc_endpoint.dumps(self._record(index, row, response)) + b"\n")
+                    checkpoint.mark(index)
+                    self.completed += 1
+                    if isinstance(response, Exception):
+                        self.errors += 1
+                    if self.completed % self.checkpoint_every == 0:
+                        output.flush()
+                        checkpoint.save(output.tell())
+                        if progress is not None:
+                            rate = self.completed / (time.monotonic() - start)
+                            progress.write(f"{self.completed} done ({self.errors} errors), {self.unfinished} to "
+                                           f"retry, {rate:.1f}/s, resume point {checkpoint.next_index}\n")
+                            progress.flush()
+
+                try:
+                    for params, response in pool.get_completions_batch(self._params(checkpoint, failed),
+                                                                       self.max_in_flight):
+                        while failed:
+                            write(*failed.pop())
+                        index, row, _ = self._rows.pop(id(params))
+                        write(index, row, response)
+                    while failed:
+                        write(*failed.pop())
+                finally:
+                    output.flush()
+                    checkpoint.save(output.tell())
+        finally:
+            pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", help="the manifest JSONL file")
+    parser.add_argument("output", help="the output JSONL file, appended to")
+    parser.add_argument("--root", required=True, help="the root directory of the repository")
+    parser.add_argument("--checkpoint", help="the checkpoint file (default: the output file + .checkpoint)")
+    parser.add_argument("--workers", type=int, default=1, help="the number of Copilot LSP servers (default: 1)")
+    parser.add_argument("--max-in-flight", type=int,
+                        help="the maximum number of requests in progress (default: the number of workers)")
+    parser.add_argument("--checkpoint-every", type=int, default=100,
+                        help="the number of results between two checkpoints (default: 100)")
+    parser.add_argument("--language-id", help="the language id of files with an unknown extension")
+    parser.add_argument("--copilot-agent-path", help="the path to the Copilot LSP server (agent.js)")
+    parser.add_argument("--agent-command", help="the command line that launches each LSP server instead of agent.js")
+    parser.add_argument("--cache", help="a SQLite database caching the code completions across harvests")
+    args = parser.parse_args()
+
+    harvester = Harvester(args.root, args.manifest, args.output, args.checkpoint, args.workers, args.max_in_flight,
+                          args.checkpoint_every, args.language_id, args.copilot_agent_path,
+                          shlex.split(args.agent_command) if args.agent_command else None, args.cache)
+    harvester.run(sys.stderr)
+    print(f"{harvester.completed} done ({harvester.errors} errors), {harvester.unfinished} to retry on the next run",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,25 @@
 from __future__ import annotations
 
+import array
+import bisect
+import copy
+import hashlib
+import json
 import pathlib
+import re
 
-from typing import TypedDict, Union, List
+from typing import TypedDict, Union, List, Iterable, Iterator, Tuple, Dict
+
+# the language ids of common source code file extensions
+LANGUAGE_IDS = {
+    ".c": "c", ".cc": "cpp", ".cpp": "cpp", ".cs": "csharp", ".go": "go", ".h": "c", ".hpp": "cpp", ".java": "java",
+    ".js": "javascript", ".jsx": "javascriptreact", ".kt": "kotlin", ".php": "php", ".py": "python", ".rb": "ruby",
+    ".rs": "rust", ".scala": "scala", ".sh": "shellscript", ".swift": "swift", ".ts": "typescript",
+    ".tsx": "typescriptreact",
+}
+
+# the characters outside the Basic Multilingual Plane, which take two UTF-16 code units
+_ASTRAL = re.compile("[\U00010000-\U0010FFFF]")
 
 
 class CompletionRequestPosition(TypedDict):
@@ -31,13 +48,101 @@ class CompletionRequestTextDocument(TypedDict):
     languageId: str
 
 
+class LineIndex(object):
+    """
+    The line starts of a text, computed once, for converting between indices into the text and LSP positions in
+    O(log n). LSP characters are UTF-16 code units: a character outside the Basic Multilingual Plane counts as two.
+    Lines end with "\n" or "\r\n". An index is built for one version of a text; edits return a new text, which needs
+    a new index.
+    """
+
+    __slots__ = ("text", "line_starts", "_astral")
+
+    def __init__(self, text: str):
+        self.text = text
+        line_starts = array.array("q", [0])
+        line_starts.extend(match.end() for match in re.finditer("\n", text))
+        self.line_starts = line_starts
+        # line -> the indices in the line of its characters outside the Basic Multilingual Plane, and their UTF-16
+        # columns: the index plus the number of such characters before
+        self._astral: Dict[int, Tuple[List[int], List[int]]] = {}
+        for match in _ASTRAL.finditer(text):
+            line = bisect.bisect_right(line_starts, match.start()) - 1
+            indices, columns = self._astral.setdefault(line, ([], []))
+            index = match.start() - line_starts[line]
+            columns.append(index + len(indices))
+            indices.append(index)
+
+    def __len__(self):
+        """
+        The number of lines.
+        """
+        return len(self.line_starts)
+
+    def _line_end(self, line: int) -> int:
+        if line + 1 >= len(self.line_starts):
+            return len(self.text)
+        end = self.line_starts[line + 1] - 1
+        if end > self.line_starts[line] and self.text[end - 1] == "\r":
+            end -= 1
+        return end
+
+    def offset_at(self, position: CompletionRequestPosition) -> int:
+        """
+        Convert an LSP position to an index into the text.
+        :param position: the position in the text
+        :return: the index into the text, clamped to the end of the line and to the text
+        """
+        line = position["line"]
+        if line >= len(self.line_starts):
+            return len(self.text)
+        character = position["character"]
+        astral = self._astral.get(line)
+        if astral is not None:
+            # a column inside a surrogate pair rounds up to the end of its character
+            character -= bisect.bisect_left(astral[1], character - 1)
+        start = self.line_starts[line]
+        return min(start + max(character, 0), self._line_end(line))
+
+    def position_at(self, offset: int) -> CompletionRequestPosition:
+        """
+        Convert an index into the text to an LSP position.
+        :param offset: the index into the text, clamped to the text
+        :return: the position in the text
+        """
+        offset = min(max(offset, 0), len(self.text))
+        line = bisect.bisect_right(self.line_starts, offset) - 1
+        character = offset - self.line_starts[line]
+        astral = self._astral.get(line)
+        if astral is not None:
+            character += bisect.bisect_left(astral[0], character)
+        return {"line": line, "character": character}
+
+    def range_offsets(self, text_range: CompletionResponseRange) -> Tuple[int, int]:
+        """
+        The start and end indices into the text of an LSP range.
+        """
+        return self.offset_at(text_range["start"]), self.offset_at(text_range["end"])
+
+    def apply_edit(self, edit_range: CompletionResponseRange, new_text: str) -> str:
+        """
+        The text with a range replaced, e.g. by a code completion:
+        ``index.apply_edit(candidate["range"], candidate["text"])``.
+        :param edit_range: the range to replace. An empty range inserts new_text.
+        :param new_text: the text to put in place of the range
+        :return: the new text
+        """
+        start, end = self.range_offsets(edit_range)
+        return self.text[:start] + new_text + self.text[end:]
+
+
 class CompletionRequestParams(object):
     """
     The params for the request of getCompletion request to Copilot.
     """
 
     def __init__(self, doc_file: str, language_id: str, position: CompletionRequestPosition, insert_spaces: bool = True,
-                 tab_size: int = 4, indent_size: int = 4):
+                 tab_size: int = 4, indent_size: int = 4, source: Union[None, str, bytes, memoryview] = None):
         """
         The request params for the code completion request to Copilot.
         :param doc_file: the path to the source code file to get completions for
@@ -47,6 +152,8 @@ class CompletionRequestParams(object):
         :param insert_spaces: whether to use spaces instead of tabs
         :param tab_size: the number of spaces to use for a tab
         :param indent_size: the number of spaces to use for an indent
+        :param source: optional, the source code. UTF-8 bytes are decoded once. If not given, the source code is read
+                       from doc_file for every request.
         """
         self.doc_file = doc_file
         self.language_id = language_id
@@ -54,30 +161,111 @@ class CompletionRequestParams(object):
         self.insert_spaces = insert_spaces
         self.tab_size = tab_size
         self.indent_size = indent_size
+        self.source = str(source, "utf-8") if isinstance(source, (bytes, memoryview)) else source
+        self._uri = None
+        self._relative_paths = {}
+        self._line_index = None
+
+    @classmethod
+    def from_source(cls, source: Union[str, bytes, memoryview], path: str, language_id: str,
+                    position: CompletionRequestPosition, insert_spaces: bool = True, tab_size: int = 4,
+                    indent_size: int = 4) -> CompletionRequestParams:
+        """
+        The request params for the code completion of source code in memory. The file system is never accessed.
+        :param source: the source code, as text or UTF-8 bytes
+        :param path: the absolute path of the source code. The file does not need to exist.
+        See __init__ for the other parameters.
+        """
+        return cls(path, language_id, position, insert_spaces, tab_size, indent_size, source)
+
+    def with_position(self, position: CompletionRequestPosition) -> CompletionRequestParams:
+        """
+        The params for the code completion at another position of the same source code. The source code, uri,
+        relative paths and line index computed for this request are reused.
+        :param position: the position of the cursor
+        """
+        params = copy.copy(self)
+        params.position = position
+        return params
+
+    def with_offset(self, offset: int) -> CompletionRequestParams:
+        """
+        The params for the code completion at an index into the same source code. See with_position.
+        :param offset: the index into the source code of the cursor
+        """
+        return self.with_position(self.line_index.position_at(offset))
+
+    @property
+    def line_index(self) -> LineIndex:
+        """
+        The line index of the source code, built on first use.
+        """
+        if self._line_index is None:
+            self._line_index = LineIndex(self.source if self.source is not None
+                                         else pathlib.Path(self.doc_file).read_text())
+        return self._line_index
+
+    @property
+    def offset(self) -> int:
+        """
+        The index into the source code of the cursor.
+        """
+        return self.line_index.offset_at(self.position)
+
+    @property
+    def uri(self) -> str:
+        if self._uri is None:
+            self._uri = pathlib.Path(self.doc_file).as_uri()
+        return self._uri
+
+    def relative_path(self, root_dir: Union[None, str] = None) -> str:
+        """
+        The path of the source code file relative to root_dir.
+        :param root_dir: the root directory. Defaults to the parent directory of the source code file
+        """
+        relative_path = self._relative_paths.get(root_dir)
+        if relative_path is None:
+            path = pathlib.Path(self.doc_file)
+            relative_path = str(path.relative_to(root_dir if root_dir is not None else path.parent))
+            self._relative_paths[root_dir] = relative_path
+        return relative_path
 
     def to_dict(self, root_dir: Union[None, str] = None) -> dict:
-        if root_dir is None:
-            root_dir = pathlib.Path(self.doc_file).parent
+        uri = self.uri
+        relative_path = self.relative_path(root_dir)
         return {
             "doc": {
-                "uri": pathlib.Path(self.doc_file).as_uri(),
+                "uri": uri,
                 "path": self.doc_file,
-                "relativePath": pathlib.Path(self.doc_file).relative_to(root_dir).__str__(),
-                "source": pathlib.Path(self.doc_file).read_text(),
+                "relativePath": relative_path,
+                "source": self.source if self.source is not None else pathlib.Path(self.doc_file).read_text(),
                 "position": self.position,
                 "languageId": self.language_id,
-                "insertSpaces": True,
+                "insertSpaces": self.insert_spaces,
                 "tabSize": self.tab_size,
                 "indentSize": self.indent_size,
             },
             "textDocument": {
-                "uri": pathlib.Path(self.doc_file).as_uri(),
-                "relativePath": pathlib.Path(self.doc_file).relative_to(root_dir).__str__(),
+                "uri": uri,
+                "relativePath": relative_path,
                 "languageId": self.language_id,
             },
             "position": self.position,
         }
 
+    def cache_key(self, root_dir: Union[None, str] = None, request: dict = None) -> str:
+        """
+        A content hash of the request. Requests with the same source code, position, language and settings have the
+        same cache key.
+        :param root_dir: the root directory passed to to_dict
+        :param request: optional, the dict returned by to_dict. Pass the dict that is sent, so that the key is the
+                        hash of the request that is actually sent even if the source code file changes in between
+        """
+        if request is None:
+            request = self.to_dict(root_dir)
+        payload = json.dumps(request, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode()).hexdigest()
+
 
 class CompletionResponseRange(TypedDict):
     start: CompletionRequestPosition
@@ -99,6 +287,142 @@ class CompletionResponse(TypedDict):
     completions: List[CompletionResponseCandidate]  # a list of candidate code completions
 
 
+class Candidate(object):
+    """
+    A compact CompletionResponseCandidate, for keeping many candidates in memory. The positions are stored as plain
+    ints and the display text only when it differs from the text. The position and range dicts are built on access.
+    """
+
+    __slots__ = ("uuid", "text", "_display_text", "line", "character",
+                 "start_line", "start_character", "end_line", "end_character")
+
+    def __init__(self, uuid: str, text: str, display_text: str, line: int, character: int,
+                 start_line: int, start_character: int, end_line: int, end_character: int):
+        self.uuid = uuid
+        self.text = text
+        self._display_text = None if display_text == text else display_text
+        self.line = line
+        self.character = character
+        self.start_line = start_line
+        self.start_character = start_character
+        self.end_line = end_line
+        self.end_character = end_character
+
+    @classmethod
+    def from_dict(cls, candidate: CompletionResponseCandidate) -> Candidate:
+        position = candidate["position"]
+        candidate_range = candidate.get("range") or {"start": position, "end": position}
+        start = candidate_range["start"]
+        end = candidate_range["end"]
+        return cls(candidate.get("uuid"), candidate["text"], candidate.get("displayText", candidate["text"]),
+                   position["line"], position["character"], start["line"], start["character"],
+                   end["line"], end["character"])
+
+    @property
+    def display_text(self) -> str:
+        return self.text if self._display_text is None else self._display_text
+
+    @property
+    def position(self) -> CompletionRequestPosition:
+        return {"line": self.line, "character": self.character}
+
+    @property
+    def range(self) -> CompletionResponseRange:
+        return {"start": {"line": self.start_line, "character": self.start_character},
+                "end": {"line": self.end_line, "character": self.end_character}}
+
+    def to_dict(self) -> CompletionResponseCandidate:
+        return {"uuid": self.uuid, "text": self.text, "displayText": self.display_text, "range": self.range,
+                "position": self.position}
+
+    def __repr__(self):
+        return f"Candidate({self.to_dict()!r})"
+
+
+class CandidateArray(object):
+    """
+    A compact list of candidates, for keeping millions of them in memory. The texts and uuids are kept in lists, and
+    the six line and character numbers of each candidate are packed in one array of ints. Candidate objects are built
+    only when an item is accessed.
+    """
+
+    __slots__ = ("uuids", "texts", "display_texts", "positions")
+
+    _FIELDS = 6
+
+    def __init__(self, candidates: Iterable[Union[CompletionResponseCandidate, Candidate]] = ()):
+        """
+        :param candidates: optional, the initial candidates, as dicts or Candidate objects
+        """
+        self.uuids: List[str] = []
+        self.texts: List[str] = []
+        # None when the display text is the text
+        self.display_texts: List[Union[None, str]] = []
+        # position line, position character, start line, start character, end line, end character of each candidate
+        self.positions = array.array("i")
+        self.extend(candidates)
+
+    @classmethod
+    def from_responses(cls, responses: Iterable[CompletionResponse]) -> CandidateArray:
+        """
+        Collect the candidates of many responses.
+        """
+        candidates = cls()
+        for response in responses:
+            candidates.extend(response.get("completions", []))
+        return candidates
+
+    def append(self, candidate: Union[CompletionResponseCandidate, Candidate]):
+        if not isinstance(candidate, Candidate):
+            candidate = Candidate.from_dict(candidate)
+        self.uuids.append(candidate.uuid)
+        self.texts.append(candidate.text)
+        self.display_texts.append(candidate._display_text)
+        self.positions.extend((candidate.line, candidate.character, candidate.start_line, candidate.start_character,
+                               candidate.end_line, candidate.end_character))
+
+    def extend(self, candidates: Iterable[Union[CompletionResponseCandidate, Candidate]]):
+        for candidate in candidates:
+            self.append(candidate)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, index: int) -> Candidate:
+        if index < 0:
+            index += len(self.texts)
+        if not 0 <= index < len(self.texts):
+            raise IndexError("CandidateArray index out of range")
+        text = self.texts[index]
+        display_text = self.display_texts[index]
+        offset = index * self._FIELDS
+        return Candidate(self.uuids[index], text, text if display_text is None else display_text,
+                         *self.positions[offset:offset + self._FIELDS])
+
+    def __iter__(self) -> Iterator[Candidate]:
+        for index in range(len(self.texts)):
+            yield self[index]
+
+    def position(self, index: int) -> Tuple[int, int]:
+        """
+        The line and character of the cursor of a candidate, without building the Candidate object.
+        """
+        offset = index * self._FIELDS
+        return self.positions[offset], self.positions[offset + 1]
+
+
+class PanelSolution(TypedDict):
+    """
+    A code completion of the getPanelCompletions request to Copilot.
+    """
+    panelId: str
+    range: CompletionResponseRange  # The range in the source code file to replace with the completion text
+    completionText: str
+    displayText: str  # The text to display in the text editor
+    score: float  # the mean probability of the completion tokens
+    solutionId: str  # a hash of the normalized completion text
+
+
 class SignInInitiative(TypedDict):
     status: str
     userCode: str
@@ -0,0 +1,256 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from typing import Callable, List, Iterable, Iterator, Tuple, Union, Optional
+
+import pylspclient
+from admission import AdmissionController
+from batch import iter_completions, iter_merged_candidates
+from cache import CompletionCache
+from debounce import DocumentDebouncer
+from model import CompletionRequestParams, CompletionResponse, SignInInitiative, CompletionResponseCandidate
+from service import CopilotService
+from supervisor import SupervisedCopilotService
+
+
+class CopilotServicePool(object):
+    """
+    A pool of Copilot services, each running its own Copilot LSP server process on the same root directory.
+
+    The Copilot LSP server handles one code completion at a time: a new getCompletions request cancels the one
+    in progress. Spreading requests over several servers is therefore the way to complete code in parallel.
+
+    Requests go to the least loaded Copilot service whose Copilot LSP server is alive. With supervised, each Copilot
+    service is a SupervisedCopilotService, which restarts its Copilot LSP server when it dies.
+    """
+
+    def __init__(self, root_path: str, size: int = None,
+                 copilot_agent_path: str = None,
+                 cache: CompletionCache = None,
+                 warm_up_params: CompletionRequestParams = None,
+                 agent_command: List[str] = None,
+                 admission: AdmissionController = None,
+                 supervised: bool = False):
+        """
+        Start a pool of Copilot services.
+        :param root_path: the root directory that the Copilot LSP servers run on. See CopilotService.
+        :param size: optional, the number of Copilot LSP servers to run. Defaults to the number of CPUs.
+        :param copilot_agent_path: optional, the path to the Copilot LSP server (agent.js).
+                                   Defaults to the bundled Copilot LSP
+        :param cache: optional, a cache of code completions shared by all Copilot services of the pool
+        :param warm_up_params: optional, the params of a code completion requested by every Copilot service before
+                               the pool is returned. See CopilotService.
+        :param agent_command: optional, the command line that launches each LSP server. See CopilotService.
+        :param admission: optional, admission control shared by all Copilot services of the pool, so its limits apply
+                          to the whole pool. See CopilotService.
+        :param supervised: whether to restart the Copilot LSP servers that die. Without supervision, requests only go
+                           to the Copilot LSP servers still alive.
+        """
+        self.root_path = root_path
+        self.size = size if size is not None else (os.cpu_count() or 1)
+        if self.size < 1:
+            raise ValueError(f"Invalid pool size: {self.size}")
+        self.copilot_agent_path = copilot_agent_path
+        self.cache = cache
+        self.agent_command = agent_command
+        self.supervised = supervised
+        self.admission = admission
+
+        self._lock = threading.Lock()
+        self._loads = [0] * self.size
+        self._debouncer = DocumentDebouncer(self.get_completions_async)
+        self.services: List[Union[CopilotService, SupervisedCopilotService]] = []
+        service_class = SupervisedCopilotService if supervised else CopilotService
+        futures = [service_class.launch(root_path, copilot_agent_path, cache, warm_up_params, agent_command,
+                                         admission=admission)
+                   for _ in range(self.size)]
+        try:
+            for future in futures:
+                self.services.append(future.result())
+        except BaseException:
+            for future in futures:
+                if future.exception() is None:
+                    future.result().shutdown()
+            raise
+
+    @property
+    def in_flight(self) -> List[int]:
+        """
+        The number of requests in progress on each Copilot service of the pool.
+        """
+        with self._lock:
+            return list(self._loads)
+
+    def _reserve(self) -> int:
+        """
+        Reserve the Copilot service with the fewest requests in progress among those whose Copilot LSP server is
+        alive. A dead server fails its requests at once, so it would otherwise always look the least loaded.
+        :return: the index of the reserved Copilot service. It must be given back to _release.
+        :raises: EOFError if the Copilot LSP servers of an unsupervised pool all exited
+        """
+        alive = [index for index in range(self.size) if self.services[index].alive]
+        if not alive:
+            if not self.supervised:
+                raise EOFError("All the Copilot LSP servers of the pool exited")
+            # every server is restarting: the request waits for the restart of the least loaded one
+            alive = range(self.size)
+        with self._lock:
+            index = min(alive, key=self._loads.__getitem__)
+            self._loads[index] += 1
+        return index
+
+    def _release(self, index: int):
+        with self._lock:
+            self._loads[index] -= 1
+
+    @contextmanager
+    def _least_loaded(self):
+        index = self._reserve()
+        try:
+            yield self.services[index]
+        finally:
+            self._release(index)
+
+    def get_completions(self, completion_request_params: CompletionRequestParams,
+                        timeout: float = None, key: str = None) -> CompletionResponse:
+        """
+        Get code completions from the least loaded Copilot service.
+        See CopilotService.get_completions.
+        """
+        if self.admission is not None:
+            future = self.get_completions_async(completion_request_params, key)
+            lsp_endpoint = self.services[0].lsp_endpoint
+            return lsp_endpoint.wait_for(future) if timeout is None else lsp_endpoint.wait_for(future, timeout)
+        with self._least_loaded() as service:
+            return service.get_completions(completion_request_params, timeout, key)
+
+    def _submit(self, method: Callable[[CopilotService], Future]) -> Future:
+        """
+        Send a request to the least loaded Copilot service, which stays reserved until the request is finished.
+        """
+        index = self._reserve()
+        try:
+            future = method(self.services[index])
+        except BaseException:
+            self._release(index)
+            raise
+        future.add_done_callback(lambda _: self._release(index))
+        return future
+
+    def get_completions_async(self, completion_request_params: CompletionRequestParams, key: str = None) -> Future:
+        """
+        Get code completions from the least loaded Copilot service without waiting for them. With admission control,
+        the request is admitted before a Copilot service is picked, including requests answered from the cache.
+        See CopilotService.get_completions_async.
+        """
+        if self.admission is None:
+            return self._submit(lambda service: service.get_completions_async(completion_request_params, key))
+        # admit the request before picking the Copilot service, so that the requests waiting for admission do not
+        # count as load of the Copilot services they would have picked
+        self.admission.acquire(key)
+        try:
+            future = self._submit(lambda service: service.get_completions_async(completion_request_params, key,
+                                                                                admitted=True))
+        except BaseException:
+            self.admission.release()
+            raise
+        future.add_done_callback(lambda _: self.admission.release())
+        return future
+
+    def get_completions_cycling(self, completion_request_params: CompletionRequestParams,
+                                timeout: float = None) -> Iterator[CompletionResponseCandidate]:
+        """
+        Get code completions with both getCompletions and getCompletionsCycling, yielding the candidates as they
+        arrive. When the pool has more than one Copilot service, the two requests are sent at the same time to two
+        different Copilot services. See CopilotService.get_completions_cycling.
+        """
+        return iter_merged_candidates(
+            [lambda: self.get_completions_async(completion_request_params),
+             lambda: self._submit(lambda service: service.get_completions_cycling_async(completion_request_params))],
+            self.size > 1, timeout if timeout is not None else self.services[0].lsp_endpoint._timeout)
+
+    def get_completions_latest_async(self, completion_request_params: CompletionRequestParams,
+                                     delay: float = 0.0) -> Future:
+        """
+        Get code completions for the newest request of a document only. Superseded requests are cancelled, whichever
+        Copilot service they were sent to. See CopilotService.get_completions_latest_async.
+        """
+        return self._debouncer.request(completion_request_params, delay)
+
+    def get_completions_latest(self, completion_request_params: CompletionRequestParams, delay: float = 0.0,
+                               timeout: float = None) -> Optional[CompletionResponse]:
+        """
+        Get code completions for the newest request of a document only. See CopilotService.get_completions_latest.
+        """
+        timeout = timeout if timeout is not None else self.services[0].lsp_endpoint._timeout
+        return self._debouncer.wait(self.get_completions_latest_async(completion_request_params, delay),
+                                    None if timeout is None else timeout + delay)
+
+    def get_completions_batch(self, params_iterable: Iterable[CompletionRequestParams], max_in_flight: int = None
+                              ) -> Iterator[Tuple[CompletionRequestParams, Union[CompletionResponse, Exception]]]:
+        """
+        Get code completions for many requests in parallel, yielding the results as they finish.
+        :param params_iterable: the CompletionRequestParams objects to get code completions for. It is consumed lazily.
+        :param max_in_flight: optional, the maximum number of requests in progress at a time.
+                              Defaults to the size of the pool.
+        :return: an iterator of (params, response) tuples. See CopilotService.get_completions_batch.
+        """
+        return iter_completions(self.get_completions_async, params_iterable,
+                                max_in_flight if max_in_flight is not None else self.size,
+                                self.services[0].lsp_endpoint._timeout)
+
+    def metrics_snapshot(self) -> List[dict]:
+        """
+        The metrics of each Copilot service of the pool. See pylspclient.Metrics.snapshot.
+        """
+        return [service.metrics.snapshot() for service in self.services]
+
+    def metrics_prometheus(self, prefix: str = "copilot") -> str:
+        """
+        The metrics of all Copilot services of the pool in the Prometheus text format, labelled with the index of
+        the service.
+        """
+        return pylspclient.prometheus_text([({"service": str(i)}, service.metrics)
+                                            for i, service in enumerate(self.services)], prefix)
+
+    def add_workspace_folder(self, path: str, name: str = None):
+        """
+        Add a workspace folder to every Copilot service of the pool. See CopilotService.add_workspace_folder.
+        """
+        for service in self.services:
+            service.add_workspace_folder(path, name)
+
+    def remove_workspace_folder(self, path: str):
+        """
+        Remove a workspace folder from every Copilot service of the pool.
+        """
+        for service in self.services:
+            service.remove_workspace_folder(path)
+
+    def sign_in(self, callback: Callable[[SignInInitiative], None]):
+        """
+        Sign in to Copilot. The credentials are stored on disk by the Copilot LSP server, so they are shared by all
+        Copilot services of the pool. See CopilotService.sign_in.
+        """
+        return self.services[0].sign_in(callback)
+
+    def sign_out(self):
+        """
+        Sign out the current user of Copilot.
+        """
+        self.services[0].sign_out()
+
+    def signed_in(self) -> bool:
+        """
+        Check if a user is signed in to Copilot on every Copilot service of the pool.
+        """
+        return all(service.signed_in() for service in self.services)
+
+    def shutdown(self):
+        """
+        Shutdown all Copilot services of the pool.
+        """
+        with ThreadPoolExecutor(self.size) as executor:
+            for future in [executor.submit(service.shutdown) for service in self.services]:
+                future.result()
@@ -5,4 +5,8 @@ __all__ = []
 from .json_rpc_endpoint import JsonRpcEndpoint
 from .lsp_client import LspClient
 from .lsp_endpoint import LspEndpoint
+from .async_json_rpc_endpoint import AsyncJsonRpcEndpoint
+from .async_lsp_endpoint import AsyncLspEndpoint
+from .metrics import Metrics, prometheus_text
+from .trace import WireTracer
 from . import lsp_structs
@@ -0,0 +1,63 @@
+import asyncio
+
+from .json_rpc_endpoint import FrameBuffer, frame, trace_message, READ_SIZE, HEADER_END
+from .trace import SEND, RECV
+
+
+class AsyncJsonRpcEndpoint(object):
+    """
+    asyncio JSON RPC endpoint implementation. Receives and sends JSON RPC messages over a pair of asyncio streams,
+    using the same framing as JsonRpcEndpoint. More information can be found: https://www.jsonrpc.org/
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, metrics=None, tracer=None):
+        """
+        :param reader: the stream the messages are read from
+        :param writer: the stream the messages are written to
+        :param Metrics metrics: optional, counts the messages and bytes sent and received
+        :param WireTracer tracer: optional, records the recent messages sent and received
+        """
+        self.reader = reader
+        self.writer = writer
+        self.write_lock = asyncio.Lock()
+        self.frame_buffer = FrameBuffer(keep_body=tracer is not None)
+        self.metrics = metrics
+        self.tracer = tracer
+
+    async def send_request(self, message):
+        """
+        Sends the given message.
+
+        :param dict message: The message to send.
+        """
+        jsonrpc_req = frame(message)
+        async with self.write_lock:
+            self.writer.write(jsonrpc_req)
+            await self.writer.drain()
+        if self.metrics is not None:
+            self.metrics.message_sent(len(jsonrpc_req))
+        if self.tracer is not None:
+            trace_message(self.tracer, SEND, message,
+                          memoryview(jsonrpc_req)[jsonrpc_req.index(HEADER_END) + len(HEADER_END):])
+
+    async def recv_response(self):
+        """
+        Receives a message. Only one coroutine should be receiving at a time.
+
+        :return: a message, or None if the server quit
+        """
+        while True:
+            message = self.frame_buffer.next_message()
+            if message is not None:
+                if self.metrics is not None:
+                    self.metrics.message_received()
+                if self.tracer is not None:
+                    trace_message(self.tracer, RECV, message, self.frame_buffer.last_body)
+                return message
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                # server quit
+                return None
+            if self.metrics is not None:
+                self.metrics.data_received(len(data))
+            self.frame_buffer.feed(data)
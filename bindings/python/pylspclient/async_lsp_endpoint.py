@@ -0,0 +1,218 @@
+import asyncio
+import inspect
+import time
+from typing import Callable, Optional
+
+from . import lsp_structs
+
+_DEFAULT_TIMEOUT = object()
+
+
+class AsyncLspEndpoint(object):
+    """
+    asyncio counterpart of LspEndpoint. A single reader task dispatches responses to the asyncio futures of pending
+    requests, so any number of requests can be awaited concurrently on one event loop.
+    """
+
+    def __init__(self, json_rpc_endpoint, method_callback: Callable[[str, dict], None] = None,
+                 notify_callback: Callable[[str, dict], None] = None,
+                 timeout=2, metrics=None):
+        """
+        :param json_rpc_endpoint: an AsyncJsonRpcEndpoint
+        :param method_callback: called for requests from the server, may be a coroutine function
+        :param notify_callback: called for notifications from the server, may be a coroutine function
+        :param timeout: the default timeout in seconds of call_method, None to wait forever
+        :param Metrics metrics: optional, records the latency and the outcome of every request
+        """
+        self.json_rpc_endpoint = json_rpc_endpoint
+        self.notify_callback = notify_callback
+        self.method_callback = method_callback
+        self.pending = {}
+        self.next_id = 0
+        self._timeout = timeout
+        self.shutdown_flag = False
+        self.cancelled_requests = 0
+        self.late_responses = 0
+        self.metrics = metrics
+        self._timed_out = set()
+        # pending future -> (rpc id, method name)
+        self._rpc_ids = {}
+        # the loop only keeps weak references to tasks: keep the $/cancelRequest notifications alive until sent
+        self._background_tasks = set()
+        self._reader_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """
+        Start the reader task on the running event loop.
+        """
+        self._reader_task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        self.shutdown_flag = True
+
+    async def join(self):
+        """
+        Wait for the reader task to exit.
+        """
+        if self._reader_task is not None:
+            await self._reader_task
+
+    def handle_result(self, rpc_id, result, error):
+        future = self.pending.pop(rpc_id, None)
+        if future is None:
+            # the response to a cancelled request
+            self.late_responses += 1
+            if self.metrics is not None:
+                self.metrics.increment("late_responses")
+            return
+        if future.done():
+            return
+        if error:
+            future.set_exception(lsp_structs.ResponseError(error.get("code"), error.get("message"), error.get("data")))
+        else:
+            future.set_result(result)
+
+    @staticmethod
+    async def _invoke(callback, method, params):
+        result = callback(method, params)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def run(self):
+        try:
+            while not self.shutdown_flag:
+                jsonrpc_message = await self.json_rpc_endpoint.recv_response()
+                if jsonrpc_message is None:
+                    break
+                method = jsonrpc_message.get("method")
+                result = jsonrpc_message.get("result")
+                error = jsonrpc_message.get("error")
+                rpc_id = jsonrpc_message.get("id")
+                params = jsonrpc_message.get("params")
+                try:
+                    if method:
+                        if rpc_id:
+                            # a call for method
+                            if self.method_callback is not None:
+                                result = await self._invoke(self.method_callback, method, params)
+                            await self.send_response(rpc_id, result, None)
+                        else:
+                            # a call for notify
+                            if self.notify_callback is not None:
+                                await self._invoke(self.notify_callback, method, params)
+                    else:
+                        self.handle_result(rpc_id, result, error)
+                except lsp_structs.ResponseError as e:
+                    await self.send_response(rpc_id, None, e)
+        finally:
+            # nobody is going to answer the remaining requests
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(EOFError("The LSP server closed the connection"))
+
+    async def send_response(self, req_id, result, error):
+        message_dict = {"jsonrpc": "2.0", "id": req_id}
+        if result:
+            message_dict["result"] = result
+        if error:
+            message_dict["error"] = error
+        await self.json_rpc_endpoint.send_request(message_dict)
+
+    async def send_message(self, method_name, params, req_id=None):
+        message_dict = {"jsonrpc": "2.0"}
+        if req_id is not None:
+            message_dict["id"] = req_id
+        message_dict["method"] = method_name
+        message_dict["params"] = params
+        await self.json_rpc_endpoint.send_request(message_dict)
+
+    async def call_method_async(self, method_name, **kwargs) -> asyncio.Future:
+        """
+        Send a request without waiting for its response.
+
+        :return: an asyncio Future that resolves to the result of the request, or raises ResponseError.
+                 Cancelling it cancels the request on the server.
+        """
+        current_id = self.next_id
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[current_id] = future
+        self._rpc_ids[future] = (current_id, method_name)
+        future.add_done_callback(lambda f: self._rpc_ids.pop(f, None))
+        future.add_done_callback(lambda f: f.cancelled() and self._forget_request(current_id))
+        if self.metrics is not None:
+            self.metrics.request_started(method_name)
+            sent_at = time.perf_counter()
+            future.add_done_callback(lambda f: self._record(f, method_name, sent_at))
+        try:
+            await self.send_message(method_name, kwargs, current_id)
+        except asyncio.CancelledError:
+            # a future cannot hold a CancelledError as its exception: cancel it instead, without $/cancelRequest
+            self.pending.pop(current_id, None)
+            future.cancel()
+            raise
+        except BaseException as e:
+            self.pending.pop(current_id, None)
+            future.set_exception(e)
+            future.exception()
+            raise
+        return future
+
+    def _record(self, future: asyncio.Future, method_name, sent_at):
+        if future.cancelled():
+            outcome = "timeout" if future in self._timed_out else "cancelled"
+            self._timed_out.discard(future)
+        else:
+            outcome = "ok" if future.exception() is None else "error"
+        self.metrics.request_finished(method_name, time.perf_counter() - sent_at, outcome)
+
+    def _request(self, future: asyncio.Future):
+        """
+        The rpc id and the method name of a pending request, or (None, None).
+        """
+        return self._rpc_ids.get(future, (None, None))
+
+    def _forget_request(self, rpc_id):
+        if self.pending.pop(rpc_id, None) is None or self.shutdown_flag:
+            return
+        self.cancelled_requests += 1
+        task = asyncio.ensure_future(self.send_notification("$/cancelRequest", id=rpc_id))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def wait_for(self, future: asyncio.Future, timeout=_DEFAULT_TIMEOUT):
+        """
+        Wait for the result of a request sent with call_method_async. The request is cancelled if it times out.
+
+        :param future: the future returned by call_method_async
+        :param timeout: the number of seconds to wait, None to wait forever. Defaults to the timeout of the endpoint.
+        :return: the result of the request
+        """
+        try:
+            done, _ = await asyncio.wait({future}, timeout=self._timeout if timeout is _DEFAULT_TIMEOUT else timeout)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        if not done:
+            if self.metrics is not None:
+                self._timed_out.add(future)
+            tracer = getattr(self.json_rpc_endpoint, "tracer", None)
+            if tracer is not None:
+                rpc_id, method_name = self._request(future)
+                tracer.timed_out(method_name, rpc_id)
+            future.cancel()
+            raise TimeoutError()
+        return future.result()
+
+    async def call_method(self, method_name, **kwargs):
+        future = await self.call_method_async(method_name, **kwargs)
+        if self.shutdown_flag:
+            # nobody is going to wait for the response
+            future.cancel()
+            return None
+        return await self.wait_for(future)
+
+    async def send_notification(self, method_name, **kwargs):
+        await self.send_message(method_name, kwargs)
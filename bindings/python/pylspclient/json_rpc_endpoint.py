@@ -1,11 +1,19 @@
 from __future__ import print_function
 import json
+import os
 from . import lsp_structs
+from .trace import SEND, RECV
 import threading
 
-JSON_RPC_REQ_FORMAT = "Content-Length: {json_string_len}\r\n\r\n{json_string}"
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 LEN_HEADER = "Content-Length: "
 TYPE_HEADER = "Content-Type: "
+HEADER_END = b"\r\n\r\n"
+READ_SIZE = 1 << 16
 
 
 class MyEncoder(json.JSONEncoder):
@@ -14,7 +22,113 @@ class MyEncoder(json.JSONEncoder):
     """
 
     def default(self, o):  # pylint: disable=E0202
+        return _default(o)
+
+
+def _default(o):
+    if hasattr(o, "__dict__"):
         return o.__dict__
+    # the lsp_structs classes with __slots__
+    return {name: getattr(o, name) for name in o.__slots__}
+
+
+def dumps(message) -> bytes:
+    """
+    Encodes a message in UTF-8 JSON, with orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(message, default=_default)
+    return json.dumps(message, cls=MyEncoder).encode()
+
+
+def loads(data):
+    """
+    Decodes a message from UTF-8 JSON bytes, with orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def frame(message) -> bytes:
+    """
+    Encodes a message with its Content-Length header.
+    """
+    body = dumps(message)
+    return b"Content-Length: %d\r\n\r\n%b" % (len(body), body)
+
+
+def trace_message(tracer, direction, message, body):
+    """
+    Record a message in a WireTracer.
+    """
+    if isinstance(message, dict):
+        tracer.record(direction, message.get("method"), message.get("id"), len(body), body)
+    else:
+        # a batch
+        tracer.record(direction, None, None, len(body), body)
+
+
+class FrameBuffer(object):
+    """
+    Splits a stream of bytes into JSON RPC messages. Bytes are fed in chunks of any size, and every complete message
+    is parsed straight from the buffer.
+    """
+
+    def __init__(self, keep_body=False):
+        """
+        :param bool keep_body: whether to keep the body of the last parsed message in last_body, e.g. for a tracer
+        """
+        self.buffer = bytearray()
+        self.start = 0
+        self.keep_body = keep_body
+        # the body of the last parsed message, if keep_body
+        self.last_body = None
+
+    def feed(self, data):
+        """
+        Appends received bytes to the buffer.
+        """
+        if self.start and self.start * 2 >= len(self.buffer):
+            # drop the parsed messages once they are most of the buffer
+            del self.buffer[:self.start]
+            self.start = 0
+        self.buffer += data
+
+    def next_message(self):
+        """
+        Parses the next message of the buffer.
+
+        :return: the next message, or None if the buffer does not hold a complete message yet.
+        """
+        header_end = self.buffer.find(HEADER_END, self.start)
+        if header_end < 0:
+            return None
+        message_size = None
+        for line in bytes(self.buffer[self.start:header_end]).split(b"\r\n"):
+            line = line.decode("utf-8")
+            if line.startswith(LEN_HEADER):
+                line = line[len(LEN_HEADER):]
+                if not line.isdigit():
+                    raise lsp_structs.ResponseError(lsp_structs.ErrorCodes.ParseError,
+                                                    "Bad header: size is not int")
+                message_size = int(line)
+            elif line.startswith(TYPE_HEADER):
+                pass
+            else:
+                raise lsp_structs.ResponseError(lsp_structs.ErrorCodes.ParseError, "Bad header: unkown header")
+        if not message_size:
+            raise lsp_structs.ResponseError(lsp_structs.ErrorCodes.ParseError, "Bad header: missing size")
+
+        body_start = header_end + len(HEADER_END)
+        body_end = body_start + message_size
+        if body_end > len(self.buffer):
+            return None
+        body = self.buffer[body_start:body_end]
+        self.start = body_end
+        if self.keep_body:
+            self.last_body = body
+        return loads(body)
 
 
 class JsonRpcEndpoint(object):
@@ -23,21 +137,20 @@ class JsonRpcEndpoint(object):
     protocol. More information can be found: https://www.jsonrpc.org/
     """
 
-    def __init__(self, stdin, stdout):
+    def __init__(self, stdin, stdout, metrics=None, tracer=None):
+        """
+        :param stdin: the stream the messages are written to
+        :param stdout: the stream the messages are read from
+        :param Metrics metrics: optional, counts the messages and bytes sent and received
+        :param WireTracer tracer: optional, records the recent messages sent and received
+        """
         self.stdin = stdin
         self.stdout = stdout
         self.read_lock = threading.Lock()
         self.write_lock = threading.Lock()
-
-    @staticmethod
-    def __add_header(json_string):
-        """
-        Adds a header for the given json string
-
-        :param str json_string: The string
-        :return: the string with the header
-        """
-        return JSON_RPC_REQ_FORMAT.format(json_string_len=len(json_string), json_string=json_string)
+        self.frame_buffer = FrameBuffer(keep_body=tracer is not None)
+        self.metrics = metrics
+        self.tracer = tracer
 
     def send_request(self, message):
         """
@@ -45,11 +158,24 @@ class JsonRpcEndpoint(object):
 
         :param dict message: The message to send.
         """
-        json_string = json.dumps(message, cls=MyEncoder)
-        jsonrpc_req = self.__add_header(json_string)
+        jsonrpc_req = frame(message)
         with self.write_lock:
-            self.stdin.write(jsonrpc_req.encode())
+            self.stdin.write(jsonrpc_req)
             self.stdin.flush()
+        if self.metrics is not None:
+            self.metrics.message_sent(len(jsonrpc_req))
+        if self.tracer is not None:
+            trace_message(self.tracer, SEND, message,
+                          memoryview(jsonrpc_req)[jsonrpc_req.index(HEADER_END) + len(HEADER_END):])
+
+    def _read(self):
+        """
+        Reads the bytes available on stdout with a single system call, waiting for at least one byte.
+        """
+        read1 = getattr(self.stdout, "read1", None)
+        if read1 is not None:
+            return read1(READ_SIZE)
+        return os.read(self.stdout.fileno(), READ_SIZE)
 
     def recv_response(self):
         """
@@ -58,33 +184,18 @@ class JsonRpcEndpoint(object):
         :return: a message
         """
         with self.read_lock:
-            message_size = None
             while True:
-                # read header
-                line = self.stdout.readline()
-                if not line:
+                message = self.frame_buffer.next_message()
+                if message is not None:
+                    if self.metrics is not None:
+                        self.metrics.message_received()
+                    if self.tracer is not None:
+                        trace_message(self.tracer, RECV, message, self.frame_buffer.last_body)
+                    return message
+                data = self._read()
+                if not data:
                     # server quit
                     return None
-                line = line.decode("utf-8")
-                if not line.endswith("\r\n"):
-                    raise lsp_structs.ResponseError(lsp_structs.ErrorCodes.ParseError, "Bad header: missing newline")
-                # remove the "\r\n"
-                line = line[:-2]
-                if line == "":
-                    # done with the headers
-                    break
-                elif line.startswith(LEN_HEADER):
-                    line = line[len(LEN_HEADER):]
-                    if not line.isdigit():
-                        raise lsp_structs.ResponseError(lsp_structs.ErrorCodes.ParseError,
-                                                        "Bad header: size is not int")
-                    message_size = int(line)
-                elif line.startswith(TYPE_HEADER):
-                    pass
-                else:
-                    raise lsp_structs.ResponseError(lsp_structs.ErrorCodes.ParseError, "Bad header: unkown header")
-            if not message_size:
-                raise lsp_structs.ResponseError(lsp_structs.ErrorCodes.ParseError, "Bad header: missing size")
-
-            jsonrpc_res = self.stdout.read(message_size).decode("utf-8")
-            return json.loads(jsonrpc_res)
+                if self.metrics is not None:
+                    self.metrics.data_received(len(data))
+                self.frame_buffer.feed(data)
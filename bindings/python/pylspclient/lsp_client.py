@@ -96,6 +96,25 @@ class LspClient(object):
         return self.lsp_endpoint.send_notification("textDocument/didChange", textDocument=textDocument,
                                                    contentChanges=contentChanges)
 
+    def didClose(self, textDocument):
+        """
+        The document close notification is sent from the client to the server when the document got closed in the client. The document's truth
+        now exists where the document's uri points to (e.g. if the document's uri is a file uri the truth now exists on disk).
+
+        :param TextDocumentIdentifier textDocument: The document that was closed.
+        """
+        return self.lsp_endpoint.send_notification("textDocument/didClose", textDocument=textDocument)
+
+    def didChangeWorkspaceFolders(self, event):
+        """
+        The workspace/didChangeWorkspaceFolders notification is sent from the client to the server to inform the server about workspace
+        folder configuration changes.
+
+        :param WorkspaceFoldersChangeEvent event: The added and removed workspace folders, as {"added": [...], "removed": [...]}
+            lists of WorkspaceFolder ({"uri": ..., "name": ...}).
+        """
+        return self.lsp_endpoint.send_notification("workspace/didChangeWorkspaceFolders", event=event)
+
     def documentSymbol(self, textDocument):
         """
         The document symbol request is sent from the client to the server to return a flat list of all symbols found in a given text document.
@@ -1,60 +1,133 @@
 from __future__ import print_function
+import itertools
 import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from typing import Callable
 
 from . import lsp_structs
 
 
+_DEFAULT_TIMEOUT = object()
+
+
+class PendingRequest(Future):
+    """
+    The Future of a request sent by LspEndpoint. Cancelling it tells the server to stop working on the request
+    with a $/cancelRequest notification.
+    """
+
+    def __init__(self, lsp_endpoint, rpc_id, method_name):
+        super().__init__()
+        self.lsp_endpoint = lsp_endpoint
+        self.rpc_id = rpc_id
+        self.method_name = method_name
+        self.sent_at = time.perf_counter()
+        self.timed_out = False
+
+    def cancel(self):
+        if not super().cancel():
+            return False
+        self.lsp_endpoint._forget_request(self.rpc_id)
+        return True
+
+
 class LspEndpoint(threading.Thread):
     def __init__(self, json_rpc_endpoint, method_callback: Callable[[str, dict], None] = None,
                  notify_callback: Callable[[str, dict], None] = None,
-                 timeout=2):
+                 timeout=2, metrics=None):
+        """
+        :param json_rpc_endpoint: a JsonRpcEndpoint
+        :param method_callback: called for requests from the server
+        :param notify_callback: called for notifications from the server
+        :param timeout: the default timeout in seconds of call_method, None to wait forever
+        :param Metrics metrics: optional, records the latency and the outcome of every request
+        """
         threading.Thread.__init__(self)
         self.json_rpc_endpoint = json_rpc_endpoint
         self.notify_callback = notify_callback
         self.method_callback = method_callback
-        self.event_dict = {}
-        self.response_dict = {}
-        self.next_id = 0
+        self.pending = {}
+        self._pending_lock = threading.Lock()
+        self._ids = itertools.count()
         self._timeout = timeout
         self.shutdown_flag = False
+        self.cancelled_requests = 0
+        self.late_responses = 0
+        self.metrics = metrics
+        # set once the connection is closed and no more responses can arrive
+        self.closed = False
+
+    @property
+    def in_flight(self) -> int:
+        """
+        The number of requests sent to the server that have not been answered yet.
+        """
+        return len(self.pending)
 
     def handle_result(self, rpc_id, result, error):
-        self.response_dict[rpc_id] = (result, error)
-        cond = self.event_dict[rpc_id]
-        cond.acquire()
-        cond.notify()
-        cond.release()
+        with self._pending_lock:
+            future = self.pending.pop(rpc_id, None)
+            if future is None:
+                # the response to a cancelled request
+                self.late_responses += 1
+                if self.metrics is not None:
+                    self.metrics.increment("late_responses")
+                return
+        if not future.set_running_or_notify_cancel():
+            return
+        if error:
+            future.set_exception(self.response_error(error))
+        else:
+            future.set_result(result)
+
+    def response_error(self, error) -> Exception:
+        """
+        The exception of a request answered with an error. Subclasses can map errors to their own exceptions.
+
+        :param dict error: the error of the response
+        """
+        return lsp_structs.ResponseError(error.get("code"), error.get("message"), error.get("data"))
 
     def stop(self):
         self.shutdown_flag = True
 
     def run(self):
-        while not self.shutdown_flag:
-            jsonrpc_message = self.json_rpc_endpoint.recv_response()
-            if jsonrpc_message is None:
-                break
-            method = jsonrpc_message.get("method")
-            result = jsonrpc_message.get("result")
-            error = jsonrpc_message.get("error")
-            rpc_id = jsonrpc_message.get("id")
-            params = jsonrpc_message.get("params")
-            try:
-
-                if method:
-                    if rpc_id:
-                        # a call for method
-                        if self.method_callback is not None:
-                            result = self.method_callback(method, params)
-                        self.send_response(rpc_id, result, None)
+        try:
+            while not self.shutdown_flag:
+                jsonrpc_message = self.json_rpc_endpoint.recv_response()
+                if jsonrpc_message is None:
+                    break
+                method = jsonrpc_message.get("method")
+                result = jsonrpc_message.get("result")
+                error = jsonrpc_message.get("error")
+                rpc_id = jsonrpc_message.get("id")
+                params = jsonrpc_message.get("params")
+                try:
+
+                    if method:
+                        if rpc_id:
+                            # a call for method
+                            if self.method_callback is not None:
+                                result = self.method_callback(method, params)
+                            self.send_response(rpc_id, result, None)
+                        else:
+                            # a call for notify
+                            if self.notify_callback is not None:
+                                self.notify_callback(method, params)
                     else:
-                        # a call for notify
-                        if self.notify_callback is not None:
-                            self.notify_callback(method, params)
-                else:
-                    self.handle_result(rpc_id, result, error)
-            except lsp_structs.ResponseError as e:
-                self.send_response(rpc_id, None, e)
+                        self.handle_result(rpc_id, result, error)
+                except lsp_structs.ResponseError as e:
+                    self.send_response(rpc_id, None, e)
+        finally:
+            # nobody is going to answer the remaining requests
+            with self._pending_lock:
+                self.closed = True
+                pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(EOFError("The LSP server closed the connection"))
 
     def send_response(self, req_id, result, error):
         message_dict = {"jsonrpc": "2.0", "id": req_id}
@@ -72,26 +145,84 @@ class LspEndpoint(threading.Thread):
         message_dict["params"] = params
         self.json_rpc_endpoint.send_request(message_dict)
 
-    def call_method(self, method_name, **kwargs):
-        current_id = self.next_id
-        self.next_id += 1
-        cond = threading.Condition()
-        self.event_dict[current_id] = cond
+    def call_method_async(self, method_name, **kwargs) -> PendingRequest:
+        """
+        Send a request without waiting for its response.
 
-        cond.acquire()
-        self.send_message(method_name, kwargs, current_id)
-        if self.shutdown_flag:
-            return None
+        :return: a PendingRequest that resolves to the result of the request, or raises ResponseError, or EOFError
+                 if the connection is closed before the response arrives. Cancelling it cancels the request on the
+                 server.
+        :raises: EOFError if the connection is already closed
+        """
+        with self._pending_lock:
+            if self.closed:
+                raise EOFError("The LSP server closed the connection")
+            current_id = next(self._ids)
+            future = PendingRequest(self, current_id, method_name)
+            self.pending[current_id] = future
+        if self.metrics is not None:
+            self.metrics.request_started(method_name)
+            future.add_done_callback(self._record)
+        try:
+            self.send_message(method_name, kwargs, current_id)
+        except BaseException as e:
+            with self._pending_lock:
+                forgotten = self.pending.pop(current_id, None) is not None
+            if forgotten and future.set_running_or_notify_cancel():
+                future.set_exception(e)
+            raise
+        return future
+
+    def _record(self, future: PendingRequest):
+        if future.cancelled():
+            outcome = "timeout" if future.timed_out else "cancelled"
+        else:
+            outcome = "ok" if future.exception() is None else "error"
+        self.metrics.request_finished(future.method_name, time.perf_counter() - future.sent_at, outcome)
+
+    def cancel_request(self, rpc_id):
+        """
+        Stop waiting for a request and ask the server to cancel it. A response arriving later is dropped.
+
+        :param int rpc_id: the id of the request
+        """
+        future = self.pending.get(rpc_id)
+        if future is not None:
+            future.cancel()
+
+    def _forget_request(self, rpc_id):
+        with self._pending_lock:
+            if self.pending.pop(rpc_id, None) is None or self.shutdown_flag:
+                return
+            self.cancelled_requests += 1
+        self.send_notification("$/cancelRequest", id=rpc_id)
 
-        if not cond.wait(timeout=self._timeout):
+    def wait_for(self, future: Future, timeout=_DEFAULT_TIMEOUT):
+        """
+        Wait for the result of a request sent with call_method_async. The request is cancelled if it times out.
+
+        :param future: the future returned by call_method_async
+        :param timeout: the number of seconds to wait, None to wait forever. Defaults to the timeout of the endpoint.
+        :return: the result of the request
+        """
+        try:
+            return future.result(timeout=self._timeout if timeout is _DEFAULT_TIMEOUT else timeout)
+        except FutureTimeoutError:
+            if isinstance(future, PendingRequest):
+                future.timed_out = True
+                tracer = getattr(self.json_rpc_endpoint, "tracer", None)
+                if tracer is not None:
+                    tracer.timed_out(future.method_name, future.rpc_id)
+            future.cancel()
             raise TimeoutError()
-        cond.release()
 
-        self.event_dict.pop(current_id)
-        result, error = self.response_dict.pop(current_id)
-        if error:
-            raise lsp_structs.ResponseError(error.get("code"), error.get("message"), error.get("data"))
-        return result
+    def call_method(self, method_name, **kwargs):
+        future = self.call_method_async(method_name, **kwargs)
+        if self.shutdown_flag:
+            # nobody is going to wait for the response
+            future.cancel()
+            return None
+        return self.wait_for(future)
 
     def send_notification(self, method_name, **kwargs):
         self.send_message(method_name, kwargs)
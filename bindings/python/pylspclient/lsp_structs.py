@@ -15,6 +15,8 @@ def to_type(o, new_type):
 
 
 class Position(object):
+    __slots__ = ("line", "character")
+
     def __init__(self, line, character):
         """
         Constructs a new Position instance.
@@ -27,6 +29,8 @@ class Position(object):
 
 
 class Range(object):
+    __slots__ = ("start", "end")
+
     def __init__(self, start, end):
         """
         Constructs a new Range instance.
@@ -442,6 +446,10 @@ class CompletionItem(object):
     """
     """
 
+    __slots__ = ("label", "kind", "detail", "documentation", "deprecated", "presented", "sortText", "filterText",
+                 "insertText", "insertTextFormat", "textEdit", "additionalTextEdits", "commitCharacters", "command",
+                 "data", "score")
+
     def __init__(self, label, kind=None, detail=None, documentation=None, deprecated=None, presented=None,
                  sortText=None, filterText=None, insertText=None, insertTextFormat=None, textEdit=None,
                  additionalTextEdits=None, commitCharacters=None, command=None, data=None, score=0.0):
@@ -0,0 +1,195 @@
+import bisect
+import threading
+from typing import Dict, List, Tuple, Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+OUTCOMES = ("ok", "error", "timeout", "cancelled")
+
+
+class Histogram(object):
+    """
+    A histogram with fixed bucket bounds, like the Prometheus histograms.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        """
+        :return: the count, the sum and the cumulative count of each bucket, keyed by its upper bound
+        """
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class _MethodMetrics(object):
+    def __init__(self, buckets):
+        self.latency = Histogram(buckets)
+        self.in_flight = 0
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+
+
+class Metrics(object):
+    """
+    Thread safe metrics of a JSON RPC connection: per-method latency histograms, in-flight gauges and outcome
+    counters, the bytes and messages sent and received, and named event counters. Recording costs a lock and a few
+    additions, so the metrics can stay enabled.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: the upper bounds in seconds of the latency histogram buckets
+        """
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._methods: Dict[str, _MethodMetrics] = {}
+        self._counters: Dict[Tuple[str, str], int] = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.messages_sent = 0
+        self.messages_received = 0
+
+    def _method(self, method: str) -> _MethodMetrics:
+        metrics = self._methods.get(method)
+        if metrics is None:
+            metrics = self._methods[method] = _MethodMetrics(self.buckets)
+        return metrics
+
+    def request_started(self, method: str):
+        with self._lock:
+            self._method(method).in_flight += 1
+
+    def request_finished(self, method: str, seconds: float, outcome: str):
+        """
+        :param method: the method of the request
+        :param seconds: the time from sending the request to its outcome
+        :param outcome: one of "ok", "error", "timeout" and "cancelled"
+        """
+        with self._lock:
+            metrics = self._method(method)
+            metrics.in_flight -= 1
+            metrics.outcomes[outcome] += 1
+            metrics.latency.observe(seconds)
+
+    def message_sent(self, size: int):
+        with self._lock:
+            self.messages_sent += 1
+            self.bytes_sent += size
+
+    def data_received(self, size: int):
+        with self._lock:
+            self.bytes_received += size
+
+    def message_received(self):
+        with self._lock:
+            self.messages_received += 1
+
+    def increment(self, name: str, method: str = ""):
+        """
+        Count an event.
+        :param name: the name of the event, e.g. "late_responses"
+        :param method: optional, the method the event is about
+        """
+        key = (name, method)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def snapshot(self) -> dict:
+        """
+        :return: a copy of all the metrics as plain dicts and numbers
+        """
+        with self._lock:
+            counters = {}
+            for (name, method), count in self._counters.items():
+                counters.setdefault(name, {})[method] = count
+            return {
+                "requests": {method: {
+                    "in_flight": metrics.in_flight,
+                    "outcomes": dict(metrics.outcomes),
+                    "latency": metrics.latency.snapshot(),
+                } for method, metrics in self._methods.items()},
+                "counters": counters,
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "messages_sent": self.messages_sent,
+                "messages_received": self.messages_received,
+            }
+
+    def to_prometheus(self, prefix: str = "copilot", labels: Optional[Dict[str, str]] = None) -> str:
+        """
+        Export the metrics in the Prometheus text format.
+        :param prefix: the prefix of the metric names
+        :param labels: optional, labels added to every sample
+        """
+        return prometheus_text([(labels or {}, self)], prefix)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def prometheus_text(entries: List[Tuple[Dict[str, str], Metrics]], prefix: str = "copilot") -> str:
+    """
+    Export the metrics of several connections in the Prometheus text format, each metric family written once.
+    :param entries: (labels, metrics) pairs, the labels telling the connections apart
+    :param prefix: the prefix of the metric names
+    """
+    families = {}
+
+    def sample(name, kind, help_text, labels, value, suffix=""):
+        family = families.setdefault(name, (kind, help_text, []))
+        family[2].append(f"{name}{suffix}{_format_labels(labels)} {value}")
+
+    for labels, metrics in entries:
+        snapshot = metrics.snapshot()
+        for method, requests in snapshot["requests"].items():
+            method_labels = dict(labels, method=method)
+            sample(f"{prefix}_requests_in_flight", "gauge", "Requests waiting for a response.",
+                   method_labels, requests["in_flight"])
+            for outcome, count in requests["outcomes"].items():
+                sample(f"{prefix}_requests_total", "counter", "Finished requests by outcome.",
+                       dict(method_labels, outcome=outcome), count)
+            latency = requests["latency"]
+            name = f"{prefix}_request_duration_seconds"
+            for bound, count in latency["buckets"].items():
+                sample(name, "histogram", "Time from sending a request to its outcome.",
+                       dict(method_labels, le=_format_bound(bound)), count, "_bucket")
+            sample(name, "histogram", "", method_labels, latency["sum"], "_sum")
+            sample(name, "histogram", "", method_labels, latency["count"], "_count")
+        for name, counts in snapshot["counters"].items():
+            for method, count in counts.items():
+                sample(f"{prefix}_{name}_total", "counter", f"Number of {name.replace('_', ' ')}.",
+                       dict(labels, method=method) if method else labels, count)
+        sample(f"{prefix}_sent_bytes_total", "counter", "Bytes sent to the server.", labels, snapshot["bytes_sent"])
+        sample(f"{prefix}_received_bytes_total", "counter", "Bytes received from the server.",
+               labels, snapshot["bytes_received"])
+        sample(f"{prefix}_sent_messages_total", "counter", "Messages sent to the server.",
+               labels, snapshot["messages_sent"])
+        sample(f"{prefix}_received_messages_total", "counter", "Messages received from the server.",
+               labels, snapshot["messages_received"])
+
+    lines = []
+    for name, (kind, help_text, samples) in families.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
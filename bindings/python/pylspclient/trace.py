@@ -0,0 +1,119 @@
+import collections
+import datetime
+import logging
+import logging.handlers
+import sys
+import time
+from typing import List
+
+SEND = "send"
+RECV = "recv"
+LOG = "log"
+TIMEOUT = "timeout"
+
+
+class WireTracer(object):
+    """
+    Records the recent JSON RPC messages of a JsonRpcEndpoint in a ring buffer, to find out what crossed the wire
+    before the server stalled. Each entry holds the time, the direction, the method, the id and the size of the
+    message, and optionally the beginning of its body. Entries are formatted only when they are dumped or streamed
+    to a file, and an endpoint without a tracer does not pay for any of this.
+    """
+
+    def __init__(self, capacity: int = 1024, body_limit: int = 0, path: str = None,
+                 max_bytes: int = 10 * 1024 * 1024, backup_count: int = 3, dump_on_timeout: bool = False):
+        """
+        :param capacity: the number of entries kept in the ring buffer
+        :param body_limit: the number of bytes of each message body to keep, 0 to keep none
+        :param path: optional, a file every entry is also written to as it is recorded
+        :param max_bytes: the size at which the file is rotated
+        :param backup_count: the number of rotated files kept
+        :param dump_on_timeout: dump the ring buffer to stderr when a request times out
+        """
+        self.entries_buffer = collections.deque(maxlen=capacity)
+        self.body_limit = body_limit
+        self.dump_on_timeout = dump_on_timeout
+        self._handler = None
+        if path is not None:
+            self._handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                                 encoding="utf-8")
+
+    def record(self, direction: str, method, rpc_id, size: int, body=None):
+        """
+        Record a message.
+        :param direction: SEND or RECV
+        :param method: the method of the message, None for a response
+        :param rpc_id: the id of the message, None for a notification
+        :param size: the size in bytes of the message body
+        :param body: optional, the body of the message. Only body_limit bytes of it are kept.
+        """
+        if body is not None:
+            body = bytes(body[:self.body_limit]) if self.body_limit else None
+        entry = (time.time(), direction, method, rpc_id, size, body)
+        self.entries_buffer.append(entry)
+        if self._handler is not None:
+            self._write(entry)
+
+    def log(self, method: str, params: dict):
+        """
+        Record a log message of the server, e.g. a window/logMessage notification.
+        """
+        message = str(params.get("message", "")) if isinstance(params, dict) else str(params)
+        entry = (time.time(), LOG, method, None, len(message), message)
+        self.entries_buffer.append(entry)
+        if self._handler is not None:
+            self._write(entry)
+
+    def timed_out(self, method: str, rpc_id):
+        """
+        Record that a request timed out, and dump the ring buffer if dump_on_timeout is set.
+        """
+        entry = (time.time(), TIMEOUT, method, rpc_id, 0, None)
+        self.entries_buffer.append(entry)
+        if self._handler is not None:
+            self._write(entry)
+        if self.dump_on_timeout:
+            self.dump()
+
+    @staticmethod
+    def format_entry(entry) -> str:
+        timestamp, direction, method, rpc_id, size, body = entry
+        line = f"{datetime.datetime.fromtimestamp(timestamp).isoformat()} {direction}"
+        if method is not None:
+            line += f" {method}"
+        if rpc_id is not None:
+            line += f" id={rpc_id}"
+        line += f" size={size}"
+        if body is not None:
+            line += " " + (body if isinstance(body, str) else body.decode("utf-8", "replace"))
+        return line
+
+    def entries(self) -> List[dict]:
+        """
+        :return: the entries of the ring buffer, oldest first
+        """
+        return [{"time": timestamp, "direction": direction, "method": method, "id": rpc_id, "size": size,
+                 "body": body}
+                for timestamp, direction, method, rpc_id, size, body in list(self.entries_buffer)]
+
+    def dump(self, file=None):
+        """
+        Write the entries of the ring buffer, oldest first.
+        :param file: optional, a text file. Defaults to stderr
+        """
+        file = file if file is not None else sys.stderr
+        for entry in list(self.entries_buffer):
+            file.write(self.format_entry(entry) + "\n")
+        file.flush()
+
+    def _write(self, entry):
+        # handle() takes the lock of the handler, so the reader and the senders do not interleave writes or rollovers
+        self._handler.handle(logging.makeLogRecord({"msg": self.format_entry(entry), "levelno": logging.INFO,
+                                                  "levelname": "INFO"}))
+
+    def close(self):
+        """
+        Close the file the entries are written to.
+        """
+        if self._handler is not None:
+            self._handler.close()
@@ -1,12 +1,26 @@
+import collections
+import itertools
+import queue
+import shutil
 import subprocess
-from typing import Callable
+import threading
+from concurrent.futures import Future
+from typing import Callable, Iterable, Iterator, Tuple, Union, List, Optional
 
 import semver
 import os
 import pylspclient
 import pathlib
 
-from model import CompletionRequestParams, CompletionResponse, SignInInitiative
+from admission import AdmissionController, AdmissionRejected
+from batch import iter_completions, iter_merged_candidates
+from cache import CompletionCache
+from context import NeighborContext
+from debounce import DocumentDebouncer
+from document import SyncedDocument
+from model import CompletionRequestParams, CompletionResponse, SignInInitiative, PanelSolution, \
+    CompletionResponseCandidate
+from workspace import WorkspaceFolders
 
 
 class CopilotService(object):
@@ -14,70 +28,398 @@ class CopilotService(object):
     Copilot service
     """
 
+    _checked_node = None
+    _check_lock = threading.Lock()
+
     @staticmethod
     def _check_dependency():
         """
         Check if the dependency is installed.
         The Copilot LSP server requires Node.js 16.x.x.
         The node executable should be in the PATH.
+        The result is cached for the node executable, so it is checked only once per process, even by services
+        launched at the same time.
         :raises: Exception if the dependency is not satisfied.
         """
-        p = subprocess.Popen(["node", "-v"], stdout=subprocess.PIPE)
-        out, err = p.communicate()
-        if err:
-            raise Exception(f"Node.js is not executable: {err.decode('utf-8')}")
-        ver = out.decode("utf-8").strip().replace("v", "")
-        if not (semver.compare("16.0.0", ver) <= 0 and semver.compare(ver, "17.0.0")) < 0:
-            raise Exception(f"Node.js version {ver} is not supported. Please install Node.js 16")
+        with CopilotService._check_lock:
+            node = shutil.which("node")
+            if node is not None and node == CopilotService._checked_node:
+                return
+            p = subprocess.Popen(["node", "-v"], stdout=subprocess.PIPE)
+            out, err = p.communicate()
+            if err:
+                raise Exception(f"Node.js is not executable: {err.decode('utf-8')}")
+            ver = out.decode("utf-8").strip().replace("v", "")
+            if not (semver.compare("16.0.0", ver) <= 0 and semver.compare(ver, "17.0.0")) < 0:
+                raise Exception(f"Node.js version {ver} is not supported. Please install Node.js 16")
+            CopilotService._checked_node = node
+
+    @staticmethod
+    def _lsp_command(copilot_agent_path: str = None):
+        """
+        The command line that launches the Copilot LSP server.
+        :param copilot_agent_path: optional, the path to the Copilot LSP server (agent.js).
+                                   Defaults to the bundled Copilot LSP
+        """
+        return ["node", copilot_agent_path if copilot_agent_path is not None else os.path.join(
+            os.path.dirname(__file__), "..", "..", "copilot", "dist", "agent.js")]
+
+    @classmethod
+    def launch(cls, root_path: str, copilot_agent_path: str = None, cache: CompletionCache = None,
+               warm_up_params: CompletionRequestParams = None, agent_command: List[str] = None,
+               tracer: pylspclient.WireTracer = None, admission: AdmissionController = None) -> Future:
+        """
+        Start a Copilot service in the background.
+        See __init__ for the parameters.
+        :return: a Future of the CopilotService, resolved once the service is initialized and warmed up
+        """
+        future = Future()
+
+        def start():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(cls(root_path, copilot_agent_path, cache, warm_up_params, agent_command,
+                                      tracer, admission))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=start, daemon=True).start()
+        return future
 
     def __init__(self, root_path: str,
-                 copilot_agent_path: str = None):
+                 copilot_agent_path: str = None,
+                 cache: CompletionCache = None,
+                 warm_up_params: CompletionRequestParams = None,
+                 agent_command: List[str] = None,
+                 tracer: pylspclient.WireTracer = None,
+                 admission: AdmissionController = None):
         """
         Initialize the Copilot service.
         :param root_path: the root directory that Copilot LSP server runs on. Usually this should be the root directory
                           of the project for which Copilot suggests code completions.
         :param copilot_agent_path: optional, the path to the Copilot LSP server (agent.js).
                                    Defaults to the bundled Copilot LSP
+        :param cache: optional, a cache of code completions. Requests found in the cache are not sent to the Copilot
+                      LSP server.
+        :param warm_up_params: optional, the params of a code completion requested before the service is returned.
+                               The first code completion of a Copilot LSP server is much slower than the following
+                               ones. Errors of this request are ignored.
+        :param agent_command: optional, the command line that launches the LSP server instead of Node.js running
+                              agent.js, e.g. a stand-in server for benchmarks. The Node.js version is not checked.
+        :param tracer: optional, records the recent messages exchanged with the Copilot LSP server and its log
+                       messages. See pylspclient.WireTracer.
+        :param admission: optional, limits the code completion requests in progress and their rate. Requests that
+                          are not admitted raise AdmissionRejected. Requests found in the cache are always admitted.
         """
         self.root_path = root_path
-        self.workspace_folders = None
+        self.workspace = WorkspaceFolders(root_path)
         self.copilot_agent_path = copilot_agent_path
+        self.cache = cache
 
-        self._check_dependency()
-        lsp_cmd = ["node", self.copilot_agent_path if self.copilot_agent_path is not None else os.path.join(
-            os.path.dirname(__file__), "..", "..", "copilot", "dist", "agent.js")]
+        self.agent_command = agent_command
+        self.tracer = tracer
+        self.admission = admission
+
+        if agent_command is None:
+            self._check_dependency()
+            lsp_cmd = self._lsp_command(self.copilot_agent_path)
+        else:
+            lsp_cmd = agent_command
         p = subprocess.Popen(lsp_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
         self.p = p
-        json_rpc_endpoint = pylspclient.JsonRpcEndpoint(p.stdin, p.stdout)
+        self.metrics = pylspclient.Metrics()
+        json_rpc_endpoint = pylspclient.JsonRpcEndpoint(p.stdin, p.stdout, self.metrics, tracer)
         self.lsp_endpoint = pylspclient.LspEndpoint(json_rpc_endpoint,
                                                     timeout=10,
                                                     method_callback=self._callback,
-                                                    notify_callback=self._callback)
+                                                    notify_callback=self._callback,
+                                                    metrics=self.metrics)
         self.lsp_client = pylspclient.LspClient(self.lsp_endpoint)
+        self.documents = {}
+        # the recent log messages of the Copilot LSP server
+        self.log_messages = collections.deque(maxlen=256)
+        self._panels = {}
+        self._panel_ids = itertools.count(1)
+        self._debouncer = DocumentDebouncer(self.get_completions_async)
 
         self._initialize()
+        if warm_up_params is not None:
+            self._warm_up(warm_up_params)
 
     def _initialize(self):
         self.lsp_client.initialize(self.p.pid, self.root_path, pathlib.Path(self.root_path).as_uri(), None,
                                    self._client_capabilities, "off",
-                                   self.workspace_folders)
+                                   self.workspace.to_list())
         self.lsp_client.initialized()
 
+    def _root_dir(self, completion_request_params: CompletionRequestParams) -> str:
+        """
+        The workspace folder that the relative path of a request is computed against.
+        """
+        return self.workspace.root_of(completion_request_params.doc_file) or self.root_path
+
+    def _request_params(self, completion_request_params: CompletionRequestParams) -> dict:
+        return completion_request_params.to_dict(self._root_dir(completion_request_params))
+
+    def add_workspace_folder(self, path: str, name: str = None):
+        """
+        Add a workspace folder, so that the service completes the source code of another repository without launching
+        another Copilot LSP server. The relative paths of the files under it are computed against it.
+        :param path: the root directory of the repository
+        :param name: optional, the name of the workspace folder. Defaults to the name of the directory
+        """
+        folder = self.workspace.add(path, name)
+        if folder is not None:
+            self.lsp_client.didChangeWorkspaceFolders({"added": [folder], "removed": []})
+
+    def remove_workspace_folder(self, path: str):
+        """
+        Remove a workspace folder added with add_workspace_folder(). The documents opened under it stay open.
+        :param path: the root directory of the repository
+        """
+        folder = self.workspace.remove(path)
+        if folder is not None:
+            self.lsp_client.didChangeWorkspaceFolders({"added": [], "removed": [folder]})
+
+    def _warm_up(self, completion_request_params: CompletionRequestParams):
+        try:
+            self.lsp_endpoint.call_method("getCompletions", **self._request_params(completion_request_params))
+        except Exception:
+            pass
+
+    @property
+    def alive(self) -> bool:
+        """
+        Whether the Copilot LSP server is running and connected.
+        """
+        return self.p.poll() is None and not self.lsp_endpoint.closed
+
     def shutdown(self):
         """
         Shutdown the Copilot service.
         """
-        self.lsp_client.shutdown()
+        try:
+            self.lsp_client.shutdown()
+        except (EOFError, BrokenPipeError):
+            # the Copilot LSP server is already gone
+            pass
         self.p.terminate()
 
-    def get_completions(self, completion_request_params: CompletionRequestParams) -> CompletionResponse:
+    def get_completions(self, completion_request_params: CompletionRequestParams,
+                        timeout: float = None, key: str = None) -> CompletionResponse:
         """
         Get code completions.
         :param completion_request_params: a CompletionRequestParams object that specifies the source code file
                                           to suggest code completions for.
+        :param timeout: optional, the number of seconds to wait for the code completions. Defaults to the timeout of
+                        the service. The request is cancelled on the Copilot LSP server when it times out.
+        :param key: optional, the caller that the request is rate limited for. See AdmissionController.
         :return: CompletionResponse object, containing all the candidate code completions.
+        :raises: AdmissionRejected if the admission control of the service rejects the request.
+        """
+        future = self.get_completions_async(completion_request_params, key)
+        if timeout is None:
+            return self.lsp_endpoint.wait_for(future)
+        return self.lsp_endpoint.wait_for(future, timeout)
+
+    def get_completions_async(self, completion_request_params: CompletionRequestParams, key: str = None,
+                              admitted: bool = False) -> Future:
+        """
+        Get code completions without waiting for them. With admission control, this waits until the request is
+        admitted.
+        :param completion_request_params: a CompletionRequestParams object that specifies the source code file
+                                          to suggest code completions for.
+        :param key: optional, the caller that the request is rate limited for. See AdmissionController.
+        :param admitted: whether the caller already admitted the request and releases it itself, e.g.
+                         CopilotServicePool, which admits requests before picking a Copilot service.
+        :return: a Future of the CompletionResponse object. Cancelling the Future cancels the request on the Copilot
+                 LSP server.
+        :raises: AdmissionRejected if the admission control of the service rejects the request.
+        """
+        # build the request once: the cache key must be the hash of what is sent, and to_dict reads the source code
+        # file again on every call
+        request = self._request_params(completion_request_params)
+        cache_key = None
+        if self.cache is not None:
+            cache_key = completion_request_params.cache_key(request=request)
+            resp = self.cache.get(cache_key)
+            if resp is not None:
+                self.metrics.increment("cache_hits", "getCompletions")
+                future = Future()
+                future.set_result(resp)
+                return future
+            self.metrics.increment("cache_misses", "getCompletions")
+
+        if self.admission is None or admitted:
+            future = self.lsp_endpoint.call_method_async("getCompletions", **request)
+        else:
+            try:
+                self.admission.acquire(key)
+            except AdmissionRejected:
+                self.metrics.increment("admission_rejections", "getCompletions")
+                raise
+            try:
+                future = self.lsp_endpoint.call_method_async("getCompletions", **request)
+            except BaseException:
+                self.admission.release()
+                raise
+            future.add_done_callback(lambda _: self.admission.release())
+
+        if cache_key is not None:
+            def cache_response(f: Future):
+                if not f.cancelled() and f.exception() is None:
+                    self.cache.put(cache_key, f.result())
+
+            future.add_done_callback(cache_response)
+        return future
+
+    def get_completions_latest_async(self, completion_request_params: CompletionRequestParams,
+                                     delay: float = 0.0) -> Future:
+        """
+        Get code completions for the newest request of a document only, e.g. on every keystroke of an editor.
+        A new request for a document supersedes the previous one, which is cancelled whether it is still waiting or
+        already sent to the Copilot LSP server. See DocumentDebouncer.
+        :param completion_request_params: a CompletionRequestParams object that specifies the source code file
+                                          to suggest code completions for.
+        :param delay: optional, the quiet period in seconds before the request is sent, so that a request superseded
+                      within it is never sent.
+        :return: a Future of the CompletionResponse object, cancelled if a newer request supersedes it
+        """
+        return self._debouncer.request(completion_request_params, delay)
+
+    def get_completions_latest(self, completion_request_params: CompletionRequestParams, delay: float = 0.0,
+                               timeout: float = None) -> Optional[CompletionResponse]:
+        """
+        Get code completions for the newest request of a document only. See get_completions_latest_async.
+        :param timeout: optional, the number of seconds to wait for the code completions after the quiet period.
+                        Defaults to the timeout of the service.
+        :return: CompletionResponse object, or None if a newer request for the same document superseded this one.
+        """
+        timeout = timeout if timeout is not None else self.lsp_endpoint._timeout
+        return self._debouncer.wait(self.get_completions_latest_async(completion_request_params, delay),
+                                    None if timeout is None else timeout + delay)
+
+    def get_completions_batch(self, params_iterable: Iterable[CompletionRequestParams], max_in_flight: int = 1
+                              ) -> Iterator[Tuple[CompletionRequestParams, Union[CompletionResponse, Exception]]]:
+        """
+        Get code completions for many requests, yielding the results as they finish.
+        :param params_iterable: the CompletionRequestParams objects to get code completions for. It is consumed lazily.
+        :param max_in_flight: the maximum number of requests sent to the Copilot LSP server at a time.
+                              The Copilot LSP server cancels a code completion in progress when a new one is requested,
+                              so a value above 1 is only useful for requests answered from the cache.
+                              Use CopilotServicePool.get_completions_batch to complete code in parallel.
+        :return: an iterator of (params, response) tuples in the order the requests finish. The response is the
+                 exception raised by the request if it failed, or a TimeoutError if it timed out.
+        """
+        return iter_completions(self.get_completions_async, params_iterable, max_in_flight, self.lsp_endpoint._timeout)
+
+    def get_completions_cycling_async(self, completion_request_params: CompletionRequestParams) -> Future:
+        """
+        Get the code completions that editors cycle through, without waiting for them. The getCompletionsCycling
+        request returns more candidates than getCompletions.
+        :param completion_request_params: a CompletionRequestParams object that specifies the source code file
+                                          to suggest code completions for.
+        :return: a Future of the CompletionResponse object. Cancelling the Future cancels the request on the Copilot
+                 LSP server.
+        """
+        return self.lsp_endpoint.call_method_async("getCompletionsCycling",
+                                                   **self._request_params(completion_request_params))
+
+    def get_completions_cycling(self, completion_request_params: CompletionRequestParams,
+                                timeout: float = None) -> Iterator[CompletionResponseCandidate]:
+        """
+        Get code completions with both getCompletions and getCompletionsCycling, yielding the candidates as they
+        arrive. Candidates with the same uuid or text as a previous one are skipped.
+        The Copilot LSP server cancels a code completion in progress when a new one is requested, so the two requests
+        are sent one after the other. CopilotServicePool.get_completions_cycling sends them at the same time.
+        :param completion_request_params: a CompletionRequestParams object that specifies the source code file
+                                          to suggest code completions for.
+        :param timeout: optional, the number of seconds to wait for each request. Defaults to the timeout of the
+                        service.
+        :return: an iterator of the unique candidates
+        """
+        return iter_merged_candidates([lambda: self.get_completions_async(completion_request_params),
+                                       lambda: self.get_completions_cycling_async(completion_request_params)],
+                                      False, timeout if timeout is not None else self.lsp_endpoint._timeout)
+
+    def get_panel_completions(self, completion_request_params: CompletionRequestParams,
+                              timeout: float = None) -> Iterator[PanelSolution]:
+        """
+        Get up to ten code completions, like the Copilot panel of the editors. Each code completion is yielded as soon
+        as the Copilot LSP server sends it, while the following ones are still being synthesized. Duplicated code
+        completions are yielded once.
+        :param completion_request_params: a CompletionRequestParams object that specifies the source code file
+                                          to suggest code completions for.
+        :param timeout: optional, the number of seconds to wait for each code completion. Defaults to the timeout of
+                        the service.
+        :return: an iterator of the code completions
+        :raises: Exception if the Copilot LSP server fails to synthesize the code completions.
+        """
+        timeout = timeout if timeout is not None else self.lsp_endpoint._timeout
+        panel_id = f"copilot:///{next(self._panel_ids)}"
+        solutions = queue.Queue()
+        self._panels[panel_id] = solutions
+        seen = set()
+        try:
+            self.lsp_endpoint.wait_for(
+                self.lsp_endpoint.call_method_async("getPanelCompletions", panelId=panel_id,
+                                                    **self._request_params(completion_request_params)),
+                timeout)
+            while True:
+                try:
+                    key, data = solutions.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError()
+                if key == "PanelSolution":
+                    if data.get("solutionId") not in seen:
+                        seen.add(data.get("solutionId"))
+                        yield data
+                elif data.get("status") == "OK":
+                    return
+                else:
+                    raise Exception(f"Copilot panel completions failed: {data.get('message')}")
+        finally:
+            del self._panels[panel_id]
+
+    def open_document(self, doc_file: str, language_id: str, text: str = None) -> SyncedDocument:
+        """
+        Open a document on the Copilot LSP server. Code completions for the document are then requested with
+        SyncedDocument.completion_params(), which refers to the synced document instead of sending its source code.
+        Changes of the document must be reported through SyncedDocument.edit() or SyncedDocument.replace().
+        :param doc_file: the path to the source code file
+        :param language_id: the language id of the source code file
+        :param text: optional, the content of the document. Defaults to the content of doc_file on disk
+        :return: the synced document. If the document is already open, the open SyncedDocument is returned.
+        """
+        uri = pathlib.Path(doc_file).as_uri()
+        document = self.documents.get(uri)
+        if document is None or document.closed:
+            document = SyncedDocument(self.lsp_client, doc_file, language_id,
+                                      self.workspace.root_of(doc_file) or self.root_path, text)
+            self.documents[uri] = document
+        return document
+
+    def close_document(self, document: SyncedDocument):
+        """
+        Close a document opened with open_document().
+        """
+        document.close()
+        if self.documents.get(document.uri) is document:
+            del self.documents[document.uri]
+
+    def neighbor_context(self, max_bytes: int = 2 * 1024 * 1024, max_documents: int = 32, max_neighbors: int = 8,
+                         max_file_size: int = 256 * 1024) -> NeighborContext:
+        """
+        A bounded working set of open documents that gives code completions the context of the files related to the
+        requested one: the modules it imports, the files of its directory and the recently requested files. Request
+        code completions with NeighborContext.get_completions(), and close the context when done.
+        :param max_bytes: the maximum total size in bytes of the documents the context keeps open
+        :param max_documents: the maximum number of documents the context keeps open
+        :param max_neighbors: the maximum number of neighbors opened for a request
+        :param max_file_size: the size in bytes above which a file is not opened
         """
-        return self.lsp_endpoint.call_method("getCompletions", **completion_request_params.to_dict(self.root_path))
+        return NeighborContext(self, max_bytes, max_documents, max_neighbors, max_file_size)
 
     def sign_in(self, callback: Callable[[SignInInitiative], None]):
         """
@@ -108,7 +450,14 @@ class CopilotService(object):
         return resp['status'] == 'OK' or resp['status'] == 'MaybeOK'
 
     def _callback(self, key: str, data: dict):
-        pass
+        if key == "PanelSolution" or key == "PanelSolutionsDone":
+            solutions = self._panels.get(data.get("panelId"))
+            if solutions is not None:
+                solutions.put((key, data))
+        elif key == "window/logMessage" or key == "LogMessage":
+            self.log_messages.append(data)
+            if self.tracer is not None:
+                self.tracer.log(key, data)
 
     @property
     def _client_capabilities(self):
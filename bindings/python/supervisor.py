@@ -0,0 +1,391 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Iterable, Iterator, List, Tuple, Union, Optional
+
+import pylspclient
+
+from admission import AdmissionController
+from batch import iter_completions, iter_merged_candidates
+from cache import CompletionCache
+from debounce import DocumentDebouncer
+from document import SyncedDocument
+from model import CompletionRequestParams, CompletionResponse, SignInInitiative, PanelSolution, \
+    CompletionResponseCandidate
+from service import CopilotService
+
+
+class SupervisedCopilotService(object):
+    """
+    A Copilot service that restarts its Copilot LSP server when the server exits or stops answering.
+
+    A watchdog thread checks the server every check_interval seconds. When the server process has exited, or requests
+    are waiting while nothing has been received for hang_timeout seconds, the server is killed, which fails the
+    pending requests at once with EOFError, and a new server is started and initialized. The documents opened with
+    open_document() are opened again on the new server with their current content. Consecutive restarts of a server
+    that keeps failing are delayed with an exponential backoff.
+
+    Requests sent while the server is restarting wait for the new server. A request sent to a server that turns out
+    to be dead restarts it at once and is sent again to the new server, and get_completions() also retries once on
+    the new server if the server dies while answering it.
+    """
+
+    @classmethod
+    def launch(cls, root_path: str, copilot_agent_path: str = None, cache: CompletionCache = None,
+               warm_up_params: CompletionRequestParams = None, agent_command: List[str] = None,
+               tracer: pylspclient.WireTracer = None, admission: AdmissionController = None) -> Future:
+        """
+        Start a supervised Copilot service in the background, with the default supervision settings.
+        See CopilotService.launch.
+        """
+        future = Future()
+
+        def start():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(cls(root_path, copilot_agent_path, cache, warm_up_params, agent_command,
+                                      tracer, admission))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=start, daemon=True).start()
+        return future
+
+    def __init__(self, root_path: str,
+                 copilot_agent_path: str = None,
+                 cache: CompletionCache = None,
+                 warm_up_params: CompletionRequestParams = None,
+                 agent_command: List[str] = None,
+                 tracer: pylspclient.WireTracer = None,
+                 admission: AdmissionController = None,
+                 check_interval: float = 1.0,
+                 hang_timeout: float = 30.0,
+                 restart_timeout: float = 30.0,
+                 backoff_initial: float = 0.5,
+                 backoff_max: float = 30.0):
+        """
+        Start a supervised Copilot service.
+        See CopilotService for the root_path, copilot_agent_path, cache, warm_up_params, agent_command, tracer and
+        admission parameters.
+        :param check_interval: the number of seconds between two checks of the Copilot LSP server
+        :param hang_timeout: the number of seconds without receiving anything while requests are waiting, after which
+                             the Copilot LSP server is considered stuck and restarted
+        :param restart_timeout: the number of seconds a request waits for a restarting Copilot LSP server
+        :param backoff_initial: the delay in seconds before restarting a Copilot LSP server. It doubles for each
+                                consecutive failure, up to backoff_max.
+        :param backoff_max: the maximum delay in seconds before restarting a Copilot LSP server. A server that ran
+                            longer than this resets the delay to backoff_initial.
+        """
+        self.root_path = root_path
+        self.copilot_agent_path = copilot_agent_path
+        self.cache = cache
+        self.warm_up_params = warm_up_params
+        self.agent_command = agent_command
+        self.tracer = tracer
+        self.admission = admission
+        self.check_interval = check_interval
+        self.hang_timeout = hang_timeout
+        self.restart_timeout = restart_timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.restarts = 0
+        self._debouncer = DocumentDebouncer(self.get_completions_async)
+
+        self.service = self._start()
+        self._started_at = time.monotonic()
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._ready.set()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+
+    def _start(self) -> CopilotService:
+        return CopilotService(self.root_path, self.copilot_agent_path, self.cache, self.warm_up_params,
+                              self.agent_command, self.tracer, self.admission)
+
+    @staticmethod
+    def _exited(service: CopilotService) -> bool:
+        return not service.alive
+
+    def _watch(self):
+        service = self.service
+        received = service.metrics.bytes_received
+        received_at = time.monotonic()
+        while True:
+            self._wakeup.wait(self.check_interval)
+            self._wakeup.clear()
+            if self._stopped:
+                return
+            now = time.monotonic()
+            if service.metrics.bytes_received != received or service.lsp_endpoint.in_flight == 0:
+                received = service.metrics.bytes_received
+                received_at = now
+            if not self._ready.is_set() or self._exited(service) or now - received_at > self.hang_timeout:
+                self._restart(service)
+                service = self.service
+                received = service.metrics.bytes_received
+                received_at = time.monotonic()
+
+    def _restart(self, old: CopilotService):
+        self._ready.clear()
+        # the reader of the killed server fails the pending requests with EOFError
+        old.lsp_endpoint.stop()
+        old.p.kill()
+        old.p.wait()
+        old.lsp_endpoint.join()
+        for solutions in list(old._panels.values()):
+            solutions.put(("PanelSolutionsDone", {"status": "Error", "message": "The Copilot LSP server stopped"}))
+
+        if time.monotonic() - self._started_at > self.backoff_max:
+            self._failures = 0
+        while not self._stopped:
+            time.sleep(min(self.backoff_max, self.backoff_initial * 2 ** self._failures))
+            self._failures += 1
+            try:
+                service = self._start()
+            except Exception:
+                continue
+            try:
+                for path, name in old.workspace.added():
+                    service.add_workspace_folder(path, name)
+                for uri, document in old.documents.items():
+                    if not document.closed:
+                        document.reopen(service.lsp_client)
+                        service.documents[uri] = document
+            except Exception:
+                service.shutdown()
+                continue
+            with self._lock:
+                self.service = service
+                self._started_at = time.monotonic()
+                self.restarts += 1
+                self._ready.set()
+            return
+
+    def _current(self) -> CopilotService:
+        """
+        The running Copilot service, waiting for it if it is restarting.
+        :raises: EOFError if the Copilot LSP server is not restarted within restart_timeout
+        """
+        if not self._ready.wait(self.restart_timeout):
+            raise EOFError("The Copilot LSP server is restarting")
+        return self.service
+
+    def _failed(self, service: CopilotService):
+        """
+        Restart the Copilot LSP server of service without waiting for the next check, if it is still the running one.
+        """
+        with self._lock:
+            if service is self.service and self._exited(service):
+                self._ready.clear()
+                self._wakeup.set()
+
+    def _submit(self, method: Callable[[CopilotService], Future]) -> Future:
+        """
+        Send a request to the running Copilot service. If its Copilot LSP server is found dead when sending, or dies
+        while answering, restart it without waiting for the next check and send the request once more to the new one.
+        :return: a Future of the response. Cancelling it cancels the request.
+        """
+        service = self._current()
+        try:
+            request = method(service)
+        except (EOFError, BrokenPipeError):
+            self._failed(service)
+            return method(self._current())
+        future = Future()
+        requests = [request]
+
+        def resolve(request: Future):
+            if not future.set_running_or_notify_cancel():
+                return
+            if request.cancelled():
+                future.set_exception(TimeoutError())
+            elif request.exception() is not None:
+                future.set_exception(request.exception())
+            else:
+                future.set_result(request.result())
+
+        def retry():
+            # waits for the restart, so it does not run on the reader thread of the dead server
+            try:
+                retried = method(self._current())
+            except Exception as e:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+                return
+            requests.append(retried)
+            if future.cancelled():
+                retried.cancel()
+            retried.add_done_callback(resolve)
+
+        def done(request: Future):
+            if not future.done() and not request.cancelled() \
+                    and isinstance(request.exception(), (EOFError, BrokenPipeError)):
+                self._failed(service)
+                threading.Thread(target=retry, daemon=True).start()
+            else:
+                resolve(request)
+
+        future.add_done_callback(lambda f: f.cancelled() and requests[-1].cancel())
+        request.add_done_callback(done)
+        return future
+
+    @property
+    def alive(self) -> bool:
+        """
+        Whether the Copilot LSP server is running, rather than dead or restarting.
+        """
+        return self._ready.is_set() and self.service.alive
+
+    @property
+    def lsp_endpoint(self) -> pylspclient.LspEndpoint:
+        """
+        The LSP endpoint of the running Copilot service.
+        """
+        return self.service.lsp_endpoint
+
+    @property
+    def metrics(self) -> pylspclient.Metrics:
+        """
+        The metrics of the running Copilot service. They start over when the Copilot LSP server is restarted.
+        """
+        return self.service.metrics
+
+    def shutdown(self):
+        """
+        Stop supervising and shutdown the Copilot service.
+        """
+        self._stopped = True
+        self._wakeup.set()
+        self._watchdog.join()
+        self.service.shutdown()
+
+    def get_completions(self, completion_request_params: CompletionRequestParams,
+                        timeout: float = None, key: str = None) -> CompletionResponse:
+        """
+        Get code completions. See CopilotService.get_completions.
+        """
+        service = self._current()
+        try:
+            return service.get_completions(completion_request_params, timeout, key)
+        except (EOFError, BrokenPipeError):
+            self._failed(service)
+            return self._current().get_completions(completion_request_params, timeout, key)
+
+    def get_completions_async(self, completion_request_params: CompletionRequestParams, key: str = None,
+                              admitted: bool = False) -> Future:
+        """
+        Get code completions without waiting for them. See CopilotService.get_completions_async.
+        """
+        return self._submit(lambda service: service.get_completions_async(completion_request_params, key, admitted))
+
+    def get_completions_latest_async(self, completion_request_params: CompletionRequestParams,
+                                     delay: float = 0.0) -> Future:
+        """
+        Get code completions for the newest request of a document only.
+        See CopilotService.get_completions_latest_async.
+        """
+        return self._debouncer.request(completion_request_params, delay)
+
+    def get_completions_latest(self, completion_request_params: CompletionRequestParams, delay: float = 0.0,
+                               timeout: float = None) -> Optional[CompletionResponse]:
+        """
+        Get code completions for the newest request of a document only. See CopilotService.get_completions_latest.
+        """
+        timeout = timeout if timeout is not None else self.service.lsp_endpoint._timeout
+        return self._debouncer.wait(self.get_completions_latest_async(completion_request_params, delay),
+                                    None if timeout is None else timeout + delay)
+
+    def get_completions_batch(self, params_iterable: Iterable[CompletionRequestParams], max_in_flight: int = 1
+                              ) -> Iterator[Tuple[CompletionRequestParams, Union[CompletionResponse, Exception]]]:
+        """
+        Get code completions for many requests. Each request is sent to the Copilot LSP server running when it is sent.
+        See CopilotService.get_completions_batch.
+        """
+        return iter_completions(self.get_completions_async, params_iterable, max_in_flight,
+                                self.service.lsp_endpoint._timeout)
+
+    def get_completions_cycling_async(self, completion_request_params: CompletionRequestParams) -> Future:
+        """
+        Get the code completions that editors cycle through, without waiting for them.
+        See CopilotService.get_completions_cycling_async.
+        """
+        return self._submit(lambda service: service.get_completions_cycling_async(completion_request_params))
+
+    def get_completions_cycling(self, completion_request_params: CompletionRequestParams,
+                                timeout: float = None) -> Iterator[CompletionResponseCandidate]:
+        """
+        Get code completions with both getCompletions and getCompletionsCycling.
+        See CopilotService.get_completions_cycling.
+        """
+        return iter_merged_candidates(
+            [lambda: self.get_completions_async(completion_request_params),
+             lambda: self.get_completions_cycling_async(completion_request_params)],
+            False, timeout if timeout is not None else self.service.lsp_endpoint._timeout)
+
+    def get_panel_completions(self, completion_request_params: CompletionRequestParams,
+                              timeout: float = None) -> Iterator[PanelSolution]:
+        """
+        Get up to ten code completions. If the Copilot LSP server is found dead before the first code completion, the
+        request is sent again to the restarted one. See CopilotService.get_panel_completions.
+        """
+        service = self._current()
+        solutions = service.get_panel_completions(completion_request_params, timeout)
+        try:
+            first = next(solutions)
+        except StopIteration:
+            return
+        except (EOFError, BrokenPipeError):
+            self._failed(service)
+            solutions = self._current().get_panel_completions(completion_request_params, timeout)
+        else:
+            yield first
+        yield from solutions
+
+    def open_document(self, doc_file: str, language_id: str, text: str = None) -> SyncedDocument:
+        """
+        Open a document on the Copilot LSP server. It is opened again on every restarted Copilot LSP server.
+        See CopilotService.open_document.
+        """
+        return self._current().open_document(doc_file, language_id, text)
+
+    def close_document(self, document: SyncedDocument):
+        """
+        Close a document opened with open_document().
+        """
+        self._current().close_document(document)
+
+    def add_workspace_folder(self, path: str, name: str = None):
+        """
+        Add a workspace folder. It is added again on every restarted Copilot LSP server.
+        See CopilotService.add_workspace_folder.
+        """
+        self._current().add_workspace_folder(path, name)
+
+    def remove_workspace_folder(self, path: str):
+        """
+        Remove a workspace folder added with add_workspace_folder().
+        """
+        self._current().remove_workspace_folder(path)
+
+    def sign_in(self, callback: Callable[[SignInInitiative], None]):
+        """
+        Sign in to Copilot. See CopilotService.sign_in.
+        """
+        return self._current().sign_in(callback)
+
+    def sign_out(self):
+        """
+        Sign out the current user of Copilot.
+        """
+        self._current().sign_out()
+
+    def signed_in(self) -> bool:
+        """
+        Check if a user is already signed in to Copilot.
+        """
+        return self._current().signed_in()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the binding is a set of top-level modules, imported from the directory above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+from model import CompletionRequestParams, LineIndex
+
+
+def utf16_position(text: str, offset: int) -> dict:
+    line_start = text.rfind("\n", 0, offset) + 1
+    prefix = text[line_start:offset]
+    if prefix.endswith("\r") and text[offset:offset + 1] == "\n":
+        prefix = prefix[:-1]
+    return {"line": text.count("\n", 0, offset), "character": len(prefix.encode("utf-16-le")) // 2}
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "abc",
+    "a\nb\n",
+    "a\r\nb\r\n\r\nc",
+    "x = '😀'\r\ny = '𝄞𝄞' + 'é'\r\n",
+    "😀\n\n😀😀\r\n",
+])
+def test_round_trip(text):
+    index = LineIndex(text)
+    for offset in range(len(text) + 1):
+        if text[offset - 1:offset + 1] == "\r\n":
+            # between \r and \n is not a position of the text
+            continue
+        position = index.position_at(offset)
+        assert position == utf16_position(text, offset)
+        assert index.offset_at(position) == offset
+
+
+def test_round_trip_random():
+    rng = random.Random(0)
+    alphabet = ["a", " ", "\n", "\r\n", "é", "😀", "𝄞"]
+    for _ in range(500):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+        index = LineIndex(text)
+        for offset in range(len(text) + 1):
+            if text[offset - 1:offset + 1] == "\r\n":
+                continue
+            assert index.offset_at(index.position_at(offset)) == offset
+
+
+def test_astral_columns():
+    index = LineIndex("a😀b\n𝄞")
+    assert index.position_at(2) == {"line": 0, "character": 3}
+    assert index.offset_at({"line": 0, "character": 3}) == 2
+    assert index.position_at(4) == {"line": 1, "character": 0}
+    assert index.position_at(5) == {"line": 1, "character": 2}
+    # a column inside a surrogate pair rounds up to the end of its character
+    assert index.offset_at({"line": 0, "character": 2}) == 2
+
+
+def test_crlf():
+    index = LineIndex("ab\r\ncd")
+    assert len(index) == 2
+    assert index.position_at(4) == {"line": 1, "character": 0}
+    # the \r is not part of the line
+    assert index.offset_at({"line": 0, "character": 9}) == 2
+    assert index.offset_at({"line": 1, "character": 2}) == 6
+
+
+def test_clamping():
+    index = LineIndex("ab\ncd")
+    assert index.offset_at({"line": 0, "character": 10}) == 2
+    assert index.offset_at({"line": 5, "character": 0}) == 5
+    assert index.position_at(-1) == {"line": 0, "character": 0}
+    assert index.position_at(100) == {"line": 1, "character": 2}
+
+
+def test_apply_edit():
+    index = LineIndex("def f():\r\n    return '😀'\r\n")
+    edit_range = {"start": {"line": 1, "character": 4}, "end": {"line": 1, "character": 15}}
+    assert index.apply_edit(edit_range, "pass") == "def f():\r\n    pass\r\n"
+    insertion = {"start": {"line": 1, "character": 14}, "end": {"line": 1, "character": 14}}
+    assert index.apply_edit(insertion, "!") == "def f():\r\n    return '😀!'\r\n"
+
+
+def test_params_offset():
+    params = CompletionRequestParams.from_source("x = '😀'\ny", "/tmp/a.py", "python", {"line": 0, "character": 8})
+    assert params.offset == 7
+    assert params.with_offset(8).position == {"line": 1, "character": 0}
@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+
+from cache import SqliteCompletionCache
+
+
+def response(text: str) -> dict:
+    return {"completions": [{"uuid": text, "text": text, "displayText": text}]}
+
+
+def stored_bytes(path) -> int:
+    connection = sqlite3.connect(str(path))
+    try:
+        return connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+    finally:
+        connection.close()
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "completions.db")
+
+
+def test_hit_and_miss(path):
+    cache = SqliteCompletionCache(path)
+    assert cache.get("a") is None
+    cache.put("a", response("x"))
+    assert cache.get("a") == response("x")
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.put("a", response("y"))
+    assert cache.get("a") == response("y")
+    assert len(cache) == 1
+    assert cache.total_bytes == stored_bytes(path)
+
+
+def test_ttl(path):
+    cache = SqliteCompletionCache(path, ttl=0.1)
+    cache.put("a", response("x"))
+    assert cache.get("a") == response("x")
+    time.sleep(0.2)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+    assert cache.total_bytes == 0
+
+
+def test_eviction(path):
+    cache = SqliteCompletionCache(path, max_bytes=2000, access_resolution=0)
+    for i in range(100):
+        cache.put(str(i), response("x" * 50 + str(i)))
+        # keep the first response recently used
+        assert cache.get("0") is not None
+    assert cache.evictions > 0
+    assert 0 < cache.total_bytes <= 2000
+    assert cache.total_bytes == stored_bytes(path)
+    assert cache.get("0") == response("x" * 50 + "0")
+    assert cache.get("1") is None
+    assert cache.get("99") is not None
+
+
+def test_clear(path):
+    cache = SqliteCompletionCache(path)
+    cache.put("a", response("x"))
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.total_bytes == stored_bytes(path) == 0
+
+
+def test_second_process(path):
+    cache = SqliteCompletionCache(path)
+    cache.put("a", response("x"))
+    cache.close()
+    script = ("import sys\n"
+              "from cache import SqliteCompletionCache\n"
+              "cache = SqliteCompletionCache(sys.argv[1])\n"
+              "assert cache.get('a') == {'completions': [{'uuid': 'x', 'text': 'x', 'displayText': 'x'}]}\n"
+              "cache.put('b', {'completions': []})\n")
+    binding_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", script, path], cwd=binding_dir, check=True)
+    reopened = SqliteCompletionCache(path)
+    assert reopened.get("b") == {"completions": []}
+    assert len(reopened) == 2
+    assert reopened.total_bytes == stored_bytes(path)
@@ -0,0 +1,99 @@
+import os
+import pathlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+class WorkspaceFolders(object):
+    """
+    The workspace folders of a Copilot LSP server, so that one server serves the source code of many root directories.
+    The root directory the server was initialized with is always a workspace folder; other folders are added and
+    removed at runtime. A source code file belongs to the innermost workspace folder containing it.
+    """
+
+    def __init__(self, root_path: str):
+        """
+        :param root_path: the root directory the Copilot LSP server is initialized with
+        """
+        self.root_path = root_path
+        # absolute path -> (path as given, name)
+        self._folders: Dict[str, Tuple[str, str]] = {}
+        self._lock = threading.Lock()
+        self._folders[os.path.abspath(root_path)] = (root_path, self._name(root_path))
+
+    @staticmethod
+    def _name(path: str) -> str:
+        return os.path.basename(os.path.abspath(path))
+
+    @staticmethod
+    def folder(path: str, name: str) -> dict:
+        """
+        The WorkspaceFolder object of a directory.
+        """
+        return {"uri": pathlib.Path(os.path.abspath(path)).as_uri(), "name": name}
+
+    def to_list(self) -> List[dict]:
+        """
+        The WorkspaceFolder objects of all the workspace folders, the root directory first.
+        """
+        return [self.folder(path, name) for path, name in list(self._folders.values())]
+
+    def added(self) -> List[Tuple[str, str]]:
+        """
+        The paths and names of the workspace folders added after the root directory.
+        """
+        root = os.path.abspath(self.root_path)
+        return [folder for key, folder in list(self._folders.items()) if key != root]
+
+    def __contains__(self, path: str) -> bool:
+        return os.path.abspath(path) in self._folders
+
+    def __len__(self):
+        return len(self._folders)
+
+    def add(self, path: str, name: str = None) -> Optional[dict]:
+        """
+        Add a workspace folder.
+        :param path: the directory
+        :param name: optional, the name of the workspace folder. Defaults to the name of the directory
+        :return: the WorkspaceFolder object to announce to the Copilot LSP server, or None if it is already a
+                 workspace folder
+        """
+        name = name if name is not None else self._name(path)
+        key = os.path.abspath(path)
+        with self._lock:
+            if key in self._folders:
+                return None
+            self._folders[key] = (path, name)
+        return self.folder(path, name)
+
+    def remove(self, path: str) -> Optional[dict]:
+        """
+        Remove a workspace folder.
+        :param path: the directory
+        :return: the WorkspaceFolder object to announce to the Copilot LSP server, or None if it is not a workspace
+                 folder
+        """
+        key = os.path.abspath(path)
+        if key == os.path.abspath(self.root_path):
+            raise ValueError(f"The root directory {self.root_path} cannot be removed from the workspace folders")
+        with self._lock:
+            folder = self._folders.pop(key, None)
+        return self.folder(*folder) if folder is not None else None
+
+    def root_of(self, doc_file: str) -> Optional[str]:
+        """
+        The innermost workspace folder containing a file, in O(depth of the file) lookups.
+        :param doc_file: the path of the file
+        :return: the workspace folder as it was given, or None if no workspace folder contains the file
+        """
+        folders = self._folders
+        path = os.path.dirname(os.path.abspath(doc_file))
+        while True:
+            folder = folders.get(path)
+            if folder is not None:
+                return folder[0]
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent